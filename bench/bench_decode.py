@@ -0,0 +1,119 @@
+"""Compares decode_tags against the original per-byte decoder.
+
+Run from the repository root: `python bench/bench_decode.py`.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import polytaxis
+
+def legacy_decode_tags(raw_tags, decode_one=False):
+    """The per-byte state machine decode_tags used before the bulk decoder."""
+    tags = {}
+
+    class State(object):
+        out_key = bytearray()
+        out_val = None
+        skip = False
+        before_split = True
+    s = State()
+
+    def finish():
+        key = s.out_key.decode('utf-8')
+        values = tags.get(key)
+        if values is None:
+            values = set()
+            tags[key] = values
+        values.add(
+            s.out_val.decode('utf-8')
+            if s.out_val is not None
+            else None
+        )
+
+    def append(char):
+        if s.before_split:
+            s.out_key.append(char)
+        else:
+            if s.out_val is None:
+                s.out_val = bytearray()
+            s.out_val.append(char)
+
+    for char in raw_tags:
+        if not s.skip:
+            if bytes([char]) == b'\\':
+                s.skip = True
+            elif bytes([char]) == b'\x00':
+                break
+            elif s.before_split and bytes([char]) == b'=':
+                s.before_split = False
+            elif not decode_one and bytes([char]) == polytaxis.sep2:
+                if s.out_key:
+                    finish()
+                s.out_key = bytearray()
+                s.out_val = None
+                s.before_split = True
+            else:
+                append(char)
+        else:
+            append(char)
+            s.skip = False
+
+    if decode_one and s.out_key:
+        finish()
+
+    return tags
+
+def make_header(size, escaped):
+    """Builds an encoded header of roughly `size` bytes."""
+    tags = {}
+    total = 0
+    index = 0
+    while total < size:
+        key = 'key{}'.format(index % 64)
+        value = 'value=\n{}'.format(index) if escaped else 'value{}'.format(index)
+        tags.setdefault(key, set()).add(value)
+        total += len(polytaxis.encode_tag(key, value)) + 1
+        index += 1
+    return polytaxis.encode_tags(tags)
+
+def measure(function, raw_tags):
+    timer = timeit.Timer(lambda: function(raw_tags))
+    number, elapsed = timer.autorange()
+    return elapsed / number
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark decode_tags against the legacy decoder.',
+    )
+    parser.add_argument(
+        '--legacy-max',
+        help='Largest header size to run the (slow) legacy decoder on.',
+        type=int,
+        default=10 ** 6,
+    )
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>14} {:>14} {:>9}'.format(
+        'size', 'escaped', 'legacy (s)', 'bulk (s)', 'speedup'))
+    for size in (10, 10 ** 3, 10 ** 5, 10 ** 7):
+        for escaped in (False, True):
+            raw_tags = make_header(size, escaped)
+            bulk = measure(polytaxis.decode_tags, raw_tags)
+            if size <= args.legacy_max:
+                if legacy_decode_tags(raw_tags) != polytaxis.decode_tags(raw_tags):
+                    raise AssertionError('Decoders disagree at size {}'.format(size))
+                legacy = measure(legacy_decode_tags, raw_tags)
+                legacy_text = '{:14.6f}'.format(legacy)
+                speedup_text = '{:8.1f}x'.format(legacy / bulk)
+            else:
+                legacy_text = '{:>14}'.format('skipped')
+                speedup_text = '{:>9}'.format('-')
+            print('{:>10} {:>8} {} {:14.6f} {}'.format(
+                len(raw_tags), str(escaped), legacy_text, bulk, speedup_text))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""Benchmarks the codec, header I/O and ptmod.
+
+Run from the repository root: `python bench/bench_suite.py`.  Use `--json` to
+save the results and `--compare` to compare them with a saved run, for
+example:
+
+    python bench/bench_suite.py --json before.json
+    # make changes
+    python bench/bench_suite.py --compare before.json
+
+`--filter` selects benchmarks by name and `--quick` runs smaller cases.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import polytaxis
+
+import corpus
+
+ptmod_path = os.path.join(os.path.dirname(__file__), '..', 'ptmod.py')
+benchmarks = []
+
+def benchmark(function):
+    benchmarks.append(function)
+    return function
+
+def measure(run, setup=None, min_time=0.2, repeat=3):
+    """Returns the best over `repeat` rounds of the mean time of `run`, each
+    round calling it until `min_time` seconds have been spent in it.  `setup`
+    is called untimed before each call."""
+    best = None
+    for round in range(repeat):
+        elapsed = 0.0
+        count = 0
+        while elapsed < min_time:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - start
+            count += 1
+        mean = elapsed / count
+        if best is None or mean < best:
+            best = mean
+    return best
+
+def result(name, seconds, size=None, **params):
+    return {
+        'name': name,
+        'params': params,
+        'seconds': seconds,
+        'bytes_per_second': None if size is None else size / seconds,
+    }
+
+@benchmark
+def codec(work, args):
+    rng = corpus.random.Random(0)
+    counts = (1, 16, 256) if args.quick else (1, 16, 256, 4096)
+    for count in counts:
+        for value_size in (8, 256):
+            for escaped in (False, True):
+                tags = corpus.make_tags(rng, count, value_size, escaped)
+                raw_tags = polytaxis.encode_tags(tags)
+                params = dict(
+                    tags=count, value_size=value_size, escaped=escaped)
+                yield result(
+                    'encode_tags',
+                    measure(lambda: polytaxis.encode_tags(tags)),
+                    len(raw_tags),
+                    **params
+                )
+                yield result(
+                    'decode_tags',
+                    measure(lambda: polytaxis.decode_tags(raw_tags)),
+                    len(raw_tags),
+                    **params
+                )
+
+@benchmark
+def get_tags(work, args):
+    rng = corpus.random.Random(0)
+    for count in (8, 1024):
+        tags = corpus.make_tags(rng, count, 16)
+        for kind in ('sized', 'unsized', 'untagged'):
+            path = corpus.write_file(
+                os.path.join(work, 'get_{}_{}'.format(kind, count)),
+                args.payload_size,
+                tags=None if kind == 'untagged' else tags,
+                unsized=kind == 'unsized',
+            )
+            yield result(
+                'get_tags',
+                measure(lambda: polytaxis.get_tags(path)),
+                kind=kind,
+                tags=count,
+            )
+            os.unlink(path)
+
+@benchmark
+def set_tags(work, args):
+    rng = corpus.random.Random(0)
+    tags = corpus.make_tags(rng, 8, 16)
+    bigger = corpus.make_tags(rng, 64, 16)
+    size = args.large_payload_size
+    path = corpus.write_file(os.path.join(work, 'set'), size, tags=tags)
+    yield result(
+        'set_tags',
+        measure(lambda: polytaxis.set_tags(path, tags)),
+        mode='in_place',
+        payload_size=size,
+    )
+    yield result(
+        'update_tags',
+        measure(lambda: polytaxis.update_tags(
+            path, add={'extra': set(['1'])}, remove={'extra': set(['2'])})),
+        mode='in_place',
+        payload_size=size,
+    )
+
+    def setup():
+        corpus.write_file(path, size, tags=tags, minimize=True)
+    yield result(
+        'set_tags',
+        measure(lambda: polytaxis.set_tags(path, bigger), setup, repeat=1),
+        size,
+        mode='rewrite',
+        payload_size=size,
+    )
+    os.unlink(path)
+
+@benchmark
+def strip_tags(work, args):
+    size = args.large_payload_size
+    tags = corpus.make_tags(corpus.random.Random(0), 8, 16)
+    path = os.path.join(work, 'strip.p')
+
+    def setup():
+        if os.path.exists(path[:-2]):
+            os.unlink(path[:-2])
+        corpus.write_file(path, size, tags=tags)
+    yield result(
+        'strip_tags',
+        measure(lambda: polytaxis.strip_tags(path), setup, repeat=1),
+        size,
+        payload_size=size,
+    )
+    os.unlink(path[:-2])
+
+@benchmark
+def unwrapped_read(work, args):
+    size = args.large_payload_size
+    tags = corpus.make_tags(corpus.random.Random(0), 8, 16)
+    path = corpus.write_file(os.path.join(work, 'read'), size, tags=tags)
+    for chunk_size in (4096, 64 * 1024, 1024 * 1024):
+        def run():
+            with polytaxis.open_unwrap(path, 'rb') as file:
+                while file.read(chunk_size):
+                    pass
+        yield result(
+            'unwrapped_read',
+            measure(run, repeat=1),
+            size,
+            chunk_size=chunk_size,
+            payload_size=size,
+        )
+    os.unlink(path)
+
+@benchmark
+def ptmod(work, args):
+    files = 100 if args.quick else args.files
+    root = os.path.join(work, 'ptmod')
+
+    def setup():
+        # Each run tags the untouched corpus, rather than updating the tags
+        # the previous run added
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        corpus.make_corpus(root, files=files, payload_size=args.payload_size)
+
+    def run(*argv):
+        subprocess.check_call(
+            [sys.executable, ptmod_path] + list(argv),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    for jobs in (1, 8):
+        yield result(
+            'ptmod_add',
+            measure(
+                lambda: run('-R', '-j', str(jobs), '-a', 'bench=1', root),
+                setup,
+                repeat=1,
+            ),
+            files=files,
+            jobs=jobs,
+        )
+    setup()
+    run('-R', '-a', 'bench=1', root)
+    yield result(
+        'ptmod_find',
+        measure(lambda: run('find', 'bench=1', root), repeat=1),
+        files=files,
+    )
+    shutil.rmtree(root)
+
+def key(entry):
+    return json.dumps([entry['name'], entry['params']], sort_keys=True)
+
+def describe(entry):
+    return '{} {}'.format(
+        entry['name'],
+        ' '.join(
+            '{}={}'.format(name, value)
+            for name, value in sorted(entry['params'].items())
+        ),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark polytaxis.',
+    )
+    parser.add_argument(
+        '--filter',
+        help='Only run benchmarks whose names contain this.',
+        action='append',
+    )
+    parser.add_argument(
+        '--quick',
+        help='Run fewer and smaller cases.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--files',
+        help='Number of files in the ptmod corpus.',
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        '--payload-size',
+        help='Payload size of small files.',
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        '--large-payload-size',
+        help='Payload size for rewrite, strip and read benchmarks.',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--dir',
+        help='Directory to create test files in (default: a temporary '
+        'directory).',
+    )
+    parser.add_argument(
+        '--json',
+        help='Write results to this file.',
+    )
+    parser.add_argument(
+        '--compare',
+        help='Compare with results saved with --json.',
+    )
+    args = parser.parse_args()
+    if args.large_payload_size is None:
+        args.large_payload_size = (
+            4 * 1024 * 1024 if args.quick else 64 * 1024 * 1024
+        )
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            for entry in json.load(file)['results']:
+                baseline[key(entry)] = entry
+
+    work = tempfile.mkdtemp(dir=args.dir)
+    results = []
+    try:
+        for function in benchmarks:
+            if args.filter and not any(
+                    text in function.__name__ for text in args.filter):
+                continue
+            for entry in function(work, args):
+                results.append(entry)
+                line = '{:60} {:12.6f}s'.format(
+                    describe(entry), entry['seconds'])
+                if entry['bytes_per_second'] is not None:
+                    line += ' {:10.1f} MiB/s'.format(
+                        entry['bytes_per_second'] / (1024 * 1024))
+                old = baseline.get(key(entry))
+                if old is not None:
+                    line += ' {:7.2f}x'.format(
+                        old['seconds'] / entry['seconds'])
+                print(line)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(
+                {
+                    'time': time.time(),
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                    'quick': args.quick,
+                    'results': results,
+                },
+                file,
+                indent=2,
+            )
+
+if __name__ == '__main__':
+    main()
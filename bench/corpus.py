@@ -0,0 +1,103 @@
+"""Generates synthetic polytaxis corpora for the benchmarks.
+
+Run from the repository root: `python bench/corpus.py DIRECTORY`.  The same
+`seed` always produces the same corpus.
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import polytaxis
+
+def make_tags(rng, count, value_size, escaped=False):
+    """Returns a tag dict with `count` tags with values of about
+    `value_size` characters, drawn from small pools as real tags are."""
+    tags = {}
+    for index in range(count):
+        key = 'key{}'.format(rng.randrange(max(1, count // 2)))
+        if rng.random() < 0.1:
+            value = None
+        else:
+            value = 'v{}-'.format(index).ljust(value_size, 'x')
+            if escaped:
+                half = value_size // 2
+                value = value[:half] + '=\n\\' + value[half:]
+        tags.setdefault(key, set()).add(value)
+    return tags
+
+def write_file(path, payload_size, tags=None, unsized=False, minimize=False):
+    """Writes a file with `payload_size` bytes of payload, with a header
+    unless `tags` is None.  Returns the path written."""
+    if tags is not None and not path.endswith('.p'):
+        path = '{}.p'.format(path)
+    with open(path, 'wb') as file:
+        if tags is not None:
+            polytaxis.write_tags(
+                file, tags=tags, unsized=unsized, minimize=minimize)
+        remaining = payload_size
+        block = b'\xa5' * min(remaining, 1024 * 1024)
+        while remaining > 0:
+            file.write(block[:remaining])
+            remaining -= len(block)
+    return path
+
+def make_corpus(
+        root,
+        files=1000,
+        tags=8,
+        value_size=16,
+        payload_size=4096,
+        depth=2,
+        kinds=('sized', 'unsized', 'untagged'),
+        seed=0):
+    """Fills `root` with `files` files spread over directories `depth` levels
+    deep, cycling through header `kinds`.  Returns the list of paths."""
+    rng = random.Random(seed)
+    paths = []
+    for index in range(files):
+        directory = root
+        for level in range(depth):
+            directory = os.path.join(
+                directory, 'd{}'.format(rng.randrange(4)))
+        os.makedirs(directory, exist_ok=True)
+        kind = kinds[index % len(kinds)]
+        path = os.path.join(directory, 'f{}'.format(index))
+        paths.append(write_file(
+            path,
+            payload_size,
+            tags=(
+                None if kind == 'untagged'
+                else make_tags(rng, tags, value_size)
+            ),
+            unsized=kind == 'unsized',
+        ))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic polytaxis corpus.',
+    )
+    parser.add_argument('root', help='Directory to fill.')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=8)
+    parser.add_argument('--value-size', type=int, default=16)
+    parser.add_argument('--payload-size', type=int, default=4096)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    paths = make_corpus(
+        args.root,
+        files=args.files,
+        tags=args.tags,
+        value_size=args.value_size,
+        payload_size=args.payload_size,
+        depth=args.depth,
+        seed=args.seed,
+    )
+    print('Wrote {} files to {}'.format(len(paths), args.root))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1996 @@
+import collections
+import collections.abc
+import concurrent.futures
+import ctypes
+import fnmatch
+import functools
+import io
+import mmap
+import re
+import tempfile
+import shutil
+import os
+import sys
+import threading
+import time
+import types
+import weakref
+
+magic = b'polytaxis00'
+size_size = 10
+size_limit = 10 ** size_size
+sep = b'='
+sep2 = b'\n'
+unsized_mark = b'<<<<\n'
+default_probe_size = 4096
+unsized_limit = size_limit
+
+_stats = None
+
+class IOStats(object):
+    """Totals of polytaxis file activity, collected while enabled with
+    `enable_stats`.
+
+    `operations` maps the names of the instrumented functions (`get_tags`,
+    `set_tags`, `update_tags`, `strip_tags`, `write_tags` and `decode_tags`)
+    to dicts of `calls`, `seconds`, `bytes_read` and `bytes_written`; nested
+    calls count towards each enclosing call too.  `reads`, `writes`, `seeks`,
+    `bytes_read` and `bytes_written` count file accesses, `bytes_copied` the
+    payload copied by rewrites, `unsized_scans` and `unsized_scan_bytes` the
+    searches for the end of unsized headers, and `outcomes` the write
+    outcomes as in `header_stats`.  If set, `callback` is called with the
+    name, seconds, bytes read and bytes written of each instrumented call.
+    """
+    counters = (
+        'reads',
+        'bytes_read',
+        'writes',
+        'bytes_written',
+        'seeks',
+        'bytes_copied',
+        'unsized_scans',
+        'unsized_scan_bytes',
+    )
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for counter in self.counters:
+                setattr(self, counter, 0)
+            self.operations = {}
+            self.outcomes = dict(
+                (outcome, 0) for outcome in HeaderStats.outcomes
+            )
+
+    def as_dict(self):
+        with self._lock:
+            out = dict(
+                (counter, getattr(self, counter)) for counter in self.counters
+            )
+            out['operations'] = dict(
+                (name, dict(totals))
+                for name, totals in self.operations.items()
+            )
+            out['outcomes'] = dict(self.outcomes)
+        return out
+
+    def format(self):
+        """Returns the totals as human readable lines."""
+        stats = self.as_dict()
+        lines = []
+        for name, totals in sorted(stats['operations'].items()):
+            lines.append(
+                '{}: {} calls, {:.6f}s, {} bytes read, {} bytes written'
+                .format(
+                    name,
+                    totals['calls'],
+                    totals['seconds'],
+                    totals['bytes_read'],
+                    totals['bytes_written'],
+                )
+            )
+        lines.append(', '.join(
+            '{} {}'.format(stats[counter], counter.replace('_', ' '))
+            for counter in self.counters
+        ))
+        lines.append('headers: ' + ', '.join(
+            '{} {}'.format(stats['outcomes'][outcome], outcome.replace('_', ' '))
+            for outcome in HeaderStats.outcomes
+        ))
+        return '\n'.join(lines)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for counter, amount in amounts.items():
+                setattr(self, counter, getattr(self, counter) + amount)
+        for frame in getattr(self._local, 'stack', ()):
+            for counter in ('bytes_read', 'bytes_written'):
+                frame[counter] += amounts.get(counter, 0)
+
+    def _count_outcome(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def _call(self, name, function, args, kwargs):
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = {'bytes_read': 0, 'bytes_written': 0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                totals = self.operations.get(name)
+                if totals is None:
+                    totals = self.operations[name] = {
+                        'calls': 0,
+                        'seconds': 0.0,
+                        'bytes_read': 0,
+                        'bytes_written': 0,
+                    }
+                totals['calls'] += 1
+                totals['seconds'] += seconds
+                totals['bytes_read'] += frame['bytes_read']
+                totals['bytes_written'] += frame['bytes_written']
+            if self.callback is not None:
+                self.callback(
+                    name,
+                    seconds,
+                    frame['bytes_read'],
+                    frame['bytes_written'],
+                )
+
+def enable_stats(callback=None):
+    """Starts collecting I/O statistics in a new `IOStats`, which is
+    returned."""
+    global _stats
+    _stats = IOStats(callback)
+    return _stats
+
+def disable_stats():
+    """Stops collecting I/O statistics, returning the `IOStats` (or None)."""
+    global _stats
+    stats, _stats = _stats, None
+    return stats
+
+def _instrumented(function):
+    name = function.__name__
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stats = _stats
+        if stats is None:
+            return function(*args, **kwargs)
+        return stats._call(name, function, args, kwargs)
+    return wrapper
+
+class _CountedFile(object):
+    """Counts the reads, writes and seeks on a file for `IOStats`."""
+    def __init__(self, file, stats):
+        self._file = file
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._file.close()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._stats._count(reads=1, bytes_read=len(data))
+        return data
+
+    def write(self, data):
+        written = self._file.write(data)
+        self._stats._count(writes=1, bytes_written=len(data))
+        return written
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._stats._count(seeks=1)
+        return self._file.seek(offset, whence)
+
+def _counted(file):
+    stats = _stats
+    if stats is None or isinstance(file, _CountedFile):
+        return file
+    return _CountedFile(file, stats)
+
+def _open(filename, mode):
+    return _counted(open(filename, mode))
+
+_encode_table = str.maketrans({
+    '=': '\\=',
+    '\n': '\\\n',
+    '\\': '\\\\',
+})
+
+def _escape_part(text):
+    if '\\' in text or '=' in text or '\n' in text:
+        return text.translate(_encode_table)
+    return text
+
+def _encode_part(text):
+    return _escape_part(text).encode('utf-8')
+
+def encode_tag(key, value):
+    if value is None:
+        return _encode_part(key)
+    return '='.join((_escape_part(key), _escape_part(value))).encode('utf-8')
+
+def _encode_tags(tags, escape):
+    assembled = []
+    for key, vals in tags.items():
+        key = escape(key)
+        for val in vals:
+            if val is None:
+                assembled.append(key)
+            else:
+                assembled.append('='.join((key, escape(val))))
+    assembled.append('')
+    return '\n'.join(assembled).encode('utf-8')
+
+def encode_tags(tags):
+    return _encode_tags(tags, _escape_part)
+
+def encode_tags_many(tags_list):
+    """Encodes each tag dict in `tags_list`, returning a list of raw headers.
+
+    Escaped keys and values are shared across the whole batch, so repeated
+    strings are only escaped once.
+    """
+    cache = {}
+
+    def escape(text):
+        escaped = cache.get(text)
+        if escaped is None:
+            escaped = _escape_part(text)
+            cache[text] = escaped
+        return escaped
+
+    return [_encode_tags(tags, escape) for tags in tags_list]
+
+# Splits a header into alternating literal runs and tokens (escape pairs or
+# delimiters), so escaped headers are walked per token instead of per byte.
+_decode_split = re.compile(b'(\\\\.?|[=\\n\\x00])', re.DOTALL)
+
+def _decode_add(tags, key, value):
+    key = key.decode('utf-8')
+    values = tags.get(key)
+    if values is None:
+        values = set()
+        tags[key] = values
+    values.add(value.decode('utf-8') if value else None)
+
+def _decode_plain(raw_tags, decode_one):
+    # No escapes, so every delimiter is significant and the header can be cut
+    # up with bulk bytes operations.
+    tags = {}
+    end = raw_tags.find(b'\x00')
+    if end != -1:
+        raw_tags = raw_tags[:end]
+    if decode_one:
+        lines = [raw_tags]
+    else:
+        lines = raw_tags.split(sep2)
+        # The last piece was not terminated by a newline and is discarded
+        lines.pop()
+    for line in lines:
+        key, _, value = line.partition(sep)
+        if key:
+            _decode_add(tags, key, value)
+    return tags
+
+def _decode_escaped(raw_tags, decode_one):
+    tags = {}
+    pieces = _decode_split.split(raw_tags)
+    key = None
+    parts = [pieces[0]]
+    index = 1
+    count = len(pieces)
+    while index < count:
+        token = pieces[index]
+        literal = pieces[index + 1]
+        index += 2
+        if token[:1] == b'\\':
+            parts.append(token[1:])
+        elif token == b'\x00':
+            break
+        elif token == sep:
+            if key is None:
+                key = b''.join(parts)
+                parts = []
+            else:
+                parts.append(token)
+        elif decode_one:
+            parts.append(token)
+        else:
+            if key is None:
+                key, value = b''.join(parts), None
+            else:
+                value = b''.join(parts)
+            if key:
+                _decode_add(tags, key, value)
+            key = None
+            parts = []
+        parts.append(literal)
+    if decode_one:
+        if key is None:
+            key, value = b''.join(parts), None
+        else:
+            value = b''.join(parts)
+        if key:
+            _decode_add(tags, key, value)
+    return tags
+
+_decode_special = re.compile(b'\\\\.?|[=\\n\\x00]', re.DOTALL)
+
+def _iter_raw_tags(raw_tags):
+    """Lazily yields the unescaped `(key, value)` bytes of each tag in
+    `raw_tags`, with None for missing values, as `decode_tags` decodes them.
+    """
+    if b'\\' not in raw_tags:
+        end = raw_tags.find(b'\x00')
+        if end == -1:
+            end = len(raw_tags)
+        start = 0
+        while True:
+            line_end = raw_tags.find(sep2, start, end)
+            if line_end == -1:
+                return
+            key, _, value = raw_tags[start:line_end].partition(sep)
+            if key:
+                yield key, value or None
+            start = line_end + 1
+    key = None
+    parts = []
+    last = 0
+    for match in _decode_special.finditer(raw_tags):
+        token = match.group()
+        start = match.start()
+        if token[:1] == b'\\':
+            parts.append(raw_tags[last:start])
+            parts.append(token[1:])
+        elif token == b'\x00':
+            return
+        elif token == sep:
+            if key is not None:
+                continue
+            parts.append(raw_tags[last:start])
+            key = b''.join(parts)
+            parts = []
+        else:
+            parts.append(raw_tags[last:start])
+            if key is None:
+                key, value = b''.join(parts), None
+            else:
+                value = b''.join(parts) or None
+            if key:
+                yield key, value
+            key = None
+            parts = []
+        last = match.end()
+
+def _stream_raw_tags(chunks):
+    """As `_iter_raw_tags`, but for a tag block split into `chunks`.  Only the
+    tag currently being decoded is held in memory."""
+    key = None
+    parts = []
+    carry = b''
+    for chunk in chunks:
+        data = carry + chunk if carry else chunk
+        carry = b''
+        last = 0
+        for match in _decode_special.finditer(data):
+            token = match.group()
+            start = match.start()
+            if token[:1] == b'\\':
+                parts.append(data[last:start])
+                if len(token) == 1:
+                    # The escaped byte is in the next chunk
+                    carry = token
+                    last = len(data)
+                    break
+                parts.append(token[1:])
+            elif token == b'\x00':
+                return
+            elif token == sep:
+                if key is not None:
+                    continue
+                parts.append(data[last:start])
+                key = b''.join(parts)
+                parts = []
+            else:
+                parts.append(data[last:start])
+                if key is None:
+                    key, value = b''.join(parts), None
+                else:
+                    value = b''.join(parts) or None
+                if key:
+                    yield key, value
+                key = None
+                parts = []
+            last = match.end()
+        if last < len(data):
+            parts.append(data[last:])
+
+_raw_record = re.compile(
+    b'((?:[^\\\\\\n\\x00]+|\\\\.?)*)(\\n|\\x00|$)', re.DOTALL)
+
+def _iter_raw_records(raw_tags):
+    """Yields each tag in `raw_tags` as its encoded bytes (without the
+    newline) and its unescaped `(key, value)`, skipping tags `decode_tags`
+    would ignore."""
+    if b'\\' not in raw_tags:
+        end = raw_tags.find(b'\x00')
+        if end != -1:
+            raw_tags = raw_tags[:end]
+        lines = raw_tags.split(sep2)
+        lines.pop()
+        for line in lines:
+            key, _, value = line.partition(sep)
+            if key:
+                yield line, (key, value or None)
+        return
+    for match in _raw_record.finditer(raw_tags):
+        if match.group(2) != sep2:
+            return
+        record = match.group(1)
+        for pair in _iter_raw_tags(record + sep2):
+            yield record, pair
+
+@_instrumented
+def decode_tags(raw_tags, decode_one=False):
+    if b'\\' in raw_tags:
+        return _decode_escaped(raw_tags, decode_one)
+    return _decode_plain(raw_tags, decode_one)
+
+def decode_tag(raw_tag):
+    key, values = next(iter(decode_tags(raw_tag, True).items()), None)
+    return (key, next(iter(values)))
+
+def _sized_header_end(size):
+    return len(magic) + 1 + size_size + 1 + size
+
+def _read_magic(file):
+    read = file.read(len(magic))
+    if read != magic:
+        file.seek(0)
+        return False
+    return True
+
+def _parse_size(buffer, offset, name):
+    """Parses the size block at `offset` in `buffer`.
+
+    Returns the size (-1 if unsized) and the offset of the tags.
+    """
+    size_type = buffer[offset:offset + 1]
+    if len(size_type) != 1:
+        raise ValueError(
+            'Missing size differentiator in file [{}]'.format(
+                name,
+            )
+        )
+    offset += 1
+    if size_type == b'u':
+        size = -1
+    else:
+        pre_size = buffer[offset:offset + size_size]
+        if len(pre_size) != size_size:
+            raise ValueError(
+                'file [{}] ends before header length could be read'
+                .format(
+                    name
+                )
+            )
+        try:
+            size = int(pre_size)
+        except ValueError as e:
+            raise ValueError(
+                'error reading polytaxis header length in file [{}]: {}'
+                .format(
+                    name,
+                    e,
+                )
+            )
+        offset += size_size
+    if buffer[offset:offset + 1] != sep2:
+        raise ValueError(
+            'file [{}] missing post-size newline'
+            .format(
+                name
+            )
+        )
+    return size, offset + 1
+
+def _read_size(file):
+    start = file.tell()
+    buffer = file.read(1 + size_size + 1)
+    size, end = _parse_size(buffer, 0, getattr(file, 'name', None))
+    file.seek(start + end)
+    return size
+
+def _pread(file, size, offset):
+    """Reads up to `size` bytes at `offset`, with as few syscalls as possible.
+    """
+    if not hasattr(os, 'pread'):
+        file.seek(offset)
+        return file.read(size)
+    fd = file.fileno()
+    out = os.pread(fd, size, offset)
+    if _stats is not None:
+        _stats._count(reads=1, bytes_read=len(out))
+    if len(out) == size or not out:
+        return out
+    # Large reads may be split by the kernel
+    aggregate = [out]
+    remaining = size - len(out)
+    offset += len(out)
+    while remaining:
+        out = os.pread(fd, remaining, offset)
+        if _stats is not None:
+            _stats._count(reads=1, bytes_read=len(out))
+        if not out:
+            break
+        aggregate.append(out)
+        remaining -= len(out)
+        offset += len(out)
+    return b''.join(aggregate)
+
+def _unsized_too_long(name, limit):
+    return ValueError(
+        'unsized polytaxis header in [{}] is longer than {} bytes'
+        .format(
+            name,
+            limit,
+        )
+    )
+
+def _find_unsized_mark(file, limit=None):
+    """Reads up to the unsized header end mark and returns the tags before it,
+    leaving `file` positioned after the mark.  Returns None if the file ends
+    first; raises ValueError if there are more than `limit` bytes of tags
+    (default `polytaxis.unsized_limit`).
+    """
+    if limit is None:
+        limit = unsized_limit
+    start = file.tell()
+    buffer = bytearray()
+    search = 0
+    chunk = 4096
+    while True:
+        remaining = limit + len(unsized_mark) - len(buffer)
+        if remaining <= 0:
+            raise _unsized_too_long(getattr(file, 'name', None), limit)
+        read = file.read(min(chunk, remaining))
+        if not read:
+            return None
+        buffer += read
+        end = buffer.find(unsized_mark, search)
+        if end != -1:
+            if _stats is not None:
+                _stats._count(unsized_scans=1, unsized_scan_bytes=end)
+            file.seek(start + end + len(unsized_mark))
+            del buffer[end:]
+            return bytes(buffer)
+        search = max(0, len(buffer) - len(unsized_mark) + 1)
+        chunk = min(chunk * 2, 16 * 1024 ** 2)
+
+def grow_pow2(length):
+    """The default growth policy: the next power of two, at least 512."""
+    return _shift_bit_length(length)
+
+def grow_fixed(slack):
+    """Returns a growth policy leaving `slack` spare bytes after the tags."""
+    def policy(length):
+        return length + slack
+    return policy
+
+def grow_percent(percent, minimum=0):
+    """Returns a growth policy leaving `percent` percent of the tag length
+    (but at least `minimum` bytes) spare."""
+    def policy(length):
+        return length + max(minimum, -(-length * percent // 100))
+    return policy
+
+def grow_blocks(block_size=4096, slack=0):
+    """Returns a growth policy padding the whole header, with at least
+    `slack` spare bytes, to a multiple of `block_size`."""
+    def policy(length):
+        end = _sized_header_end(length + slack)
+        return -(-end // block_size) * block_size - _sized_header_end(0)
+    return policy
+
+default_growth_policy = grow_pow2
+directory_growth_policies = {}
+
+def growth_policy(filename):
+    """Returns the growth policy for `filename`: that of the nearest
+    enclosing directory in `directory_growth_policies`, or else
+    `default_growth_policy`."""
+    if directory_growth_policies:
+        directory = os.path.dirname(os.path.abspath(filename))
+        while True:
+            policy = directory_growth_policies.get(directory)
+            if policy is not None:
+                return policy
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+    return default_growth_policy
+
+def _header_length(raw_tags, minimize, policy):
+    length = len(raw_tags)
+    if minimize:
+        return length
+    new_length = min((policy or default_growth_policy)(length), size_limit)
+    if new_length < length:
+        raise ValueError(
+            'Growth policy [{}] returned {} for {} bytes of tags'.format(
+                policy,
+                new_length,
+                length,
+            )
+        )
+    return new_length
+
+class HeaderStats(object):
+    """Counts how tag writes were carried out, to help tune growth policies.
+
+    `unchanged` writes had nothing to do, `in_place` ones fit in the existing
+    header and `insert_range` ones grew an aligned header without moving the
+    payload; `avoided` is the sum of these two.  `rewrite` writes copied the
+    payload.  If set, `callback` is called with the filename and outcome of
+    each write.
+    """
+    outcomes = ('unchanged', 'in_place', 'insert_range', 'rewrite')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for outcome in self.outcomes:
+                setattr(self, outcome, 0)
+
+    @property
+    def avoided(self):
+        return self.in_place + self.insert_range
+
+    def as_dict(self):
+        return dict(
+            (outcome, getattr(self, outcome)) for outcome in self.outcomes
+        )
+
+    def _record(self, filename, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        if _stats is not None:
+            _stats._count_outcome(outcome)
+        if self.callback is not None:
+            self.callback(filename, outcome)
+
+header_stats = HeaderStats()
+
+@_instrumented
+def write_tags(
+        file,
+        tags=None,
+        raw_tags=None,
+        unsized=False,
+        minimize=False,
+        align=None,
+        policy=None):
+    if tags is None and raw_tags is None:
+        raise TypeError('write_tags requires either \'tags\' or \'raw_tags\'.')
+    _write_tags(
+        _counted(file), tags, raw_tags, unsized, minimize, align, policy)
+
+def _write_tags(file, tags, raw_tags, unsized, minimize, align, policy):
+    file.write(magic)
+    if tags is not None:
+        raw_tags = encode_tags(tags)
+    if unsized:
+        file.write(b'u')
+        file.write(sep2)
+        file.write(raw_tags)
+        file.write(unsized_mark)
+    else:
+        file.write(b' ')
+        new_length = _header_length(raw_tags, minimize, policy)
+        if align:
+            new_length = (
+                -(-_sized_header_end(new_length) // align) * align -
+                _sized_header_end(0)
+            )
+        new_end = _sized_header_end(new_length)
+        file.write(('%0*d' % (size_size, new_length)).encode())
+        file.write(sep2)
+        file.write(raw_tags)
+        if file.tell() < new_end:
+            file.write(b'\0')
+        if file.tell() < new_end:
+            file.seek(new_end - 1)
+            file.write(b'\n')
+
+def _read_header(file, filename, probe_size):
+    # Returns the raw tags, the header size (-1 if unsized) and the offset of
+    # the tags, or None if there is no header.
+    buffer = _pread(file, probe_size, 0)
+    if buffer[:len(magic)] != magic:
+        return None
+    size, start = _parse_size(buffer, len(magic), filename)
+    if size == -1:
+        end = buffer.find(unsized_mark, start)
+        if end != -1:
+            if _stats is not None:
+                _stats._count(unsized_scans=1, unsized_scan_bytes=end - start)
+            if end - start > unsized_limit:
+                raise _unsized_too_long(filename, unsized_limit)
+            raw_tags = buffer[start:end]
+        else:
+            resume = max(start, len(buffer) - len(unsized_mark) + 1)
+            if resume - start > unsized_limit:
+                raise _unsized_too_long(filename, unsized_limit)
+            file.seek(resume)
+            raw_tags = _find_unsized_mark(
+                file, unsized_limit - (resume - start))
+            if raw_tags is None:
+                raise ValueError(
+                    'Could not find end of tags in [{}]'.format(
+                        filename
+                    )
+                )
+            raw_tags = buffer[start:resume] + raw_tags
+    else:
+        end = start + size
+        raw_tags = buffer[start:end]
+        if len(buffer) < end:
+            raw_tags += _pread(file, end - len(buffer), len(buffer))
+        if len(raw_tags) != size:
+            raise ValueError(
+                'polytaxis header in [{}] should be length {}, '
+                'got length {}'
+                .format(
+                    filename,
+                    size,
+                    len(raw_tags),
+                )
+            )
+    return raw_tags, size, start
+
+def _map_file(filename, writable=False):
+    # Maps the whole file, or returns None if it's empty (which can't be
+    # mapped)
+    with open(filename, 'r+b' if writable else 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(
+            file.fileno(),
+            0,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+        )
+
+def _map_header(mapping, filename):
+    # As `_read_header` for a file mapped in `mapping`, but returns the offset
+    # of the payload rather than the tags.
+    if mapping[:len(magic)] != magic:
+        return None
+    size, start = _parse_size(mapping, len(magic), filename)
+    if size == -1:
+        end = mapping.find(
+            unsized_mark, start, start + unsized_limit + len(unsized_mark))
+        if end == -1:
+            if len(mapping) - start >= unsized_limit + len(unsized_mark):
+                raise _unsized_too_long(filename, unsized_limit)
+            raise ValueError(
+                'Could not find end of tags in [{}]'.format(
+                    filename
+                )
+            )
+        if _stats is not None:
+            _stats._count(unsized_scans=1, unsized_scan_bytes=end - start)
+        return mapping[start:end], size, start, end + len(unsized_mark)
+    end = start + size
+    if len(mapping) < end:
+        raise ValueError(
+            'polytaxis header in [{}] should be length {}, '
+            'got length {}'
+            .format(
+                filename,
+                size,
+                len(mapping) - start,
+            )
+        )
+    return mapping[start:end], size, start, end
+
+def _map_tags(filename, lazy):
+    mapping = _map_file(filename)
+    if mapping is None:
+        return None
+    with mapping:
+        header = _map_header(mapping, filename)
+    if header is None:
+        return None
+    if lazy:
+        return TagView(header[0])
+    return decode_tags(header[0])
+
+def _read_raw_tags(file, filename, probe_size):
+    header = _read_header(file, filename, probe_size)
+    if header is None:
+        return None
+    return header[0]
+
+def _read_tags(file, filename, probe_size):
+    raw_tags = _read_raw_tags(file, filename, probe_size)
+    if raw_tags is None:
+        return None
+    return decode_tags(raw_tags)
+
+def _probe_size(probe_size):
+    if probe_size is None:
+        probe_size = default_probe_size
+    return max(probe_size, len(magic) + 1 + size_size + 1)
+
+class TagView(collections.abc.Mapping):
+    """A read-only mapping over an encoded tag block that decodes lazily.
+
+    The first access indexes the positions of the tags without decoding them;
+    afterwards only the keys and values looked up are decoded.  Values are
+    frozensets.  `to_dict` returns the tags in the `decode_tags` format.
+    """
+    def __init__(self, raw_tags):
+        self.raw_tags = bytes(raw_tags)
+        self._index = None
+        self._decoded = {}
+
+    def _get_index(self):
+        if self._index is not None:
+            return self._index
+        raw_tags = self.raw_tags
+        index = {}
+        if b'\\' in raw_tags:
+            for key, value in _iter_raw_tags(raw_tags):
+                index.setdefault(key, []).append(value)
+        else:
+            # Values are stored as offsets and only sliced out when accessed
+            end = raw_tags.find(b'\x00')
+            if end == -1:
+                end = len(raw_tags)
+            start = 0
+            while True:
+                line_end = raw_tags.find(sep2, start, end)
+                if line_end == -1:
+                    break
+                split = raw_tags.find(sep, start, line_end)
+                if split == -1:
+                    key, value = raw_tags[start:line_end], None
+                else:
+                    key = raw_tags[start:split]
+                    value = None
+                    if split + 1 < line_end:
+                        value = (split + 1, line_end)
+                if key:
+                    index.setdefault(key, []).append(value)
+                start = line_end + 1
+        self._index = index
+        return index
+
+    def _decode_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, tuple):
+            value = self.raw_tags[value[0]:value[1]]
+        return value.decode('utf-8')
+
+    def _raw_key(self, key):
+        # None for keys that can't be in the block, such as non-strings
+        if not isinstance(key, str):
+            return None
+        try:
+            return key.encode('utf-8')
+        except UnicodeEncodeError:
+            return None
+
+    def __getitem__(self, key):
+        values = self._decoded.get(key)
+        if values is not None:
+            return values
+        raw_values = self._get_index().get(self._raw_key(key))
+        if raw_values is None:
+            raise KeyError(key)
+        values = frozenset(self._decode_value(value) for value in raw_values)
+        self._decoded[key] = values
+        return values
+
+    def __contains__(self, key):
+        return self._raw_key(key) in self._get_index()
+
+    def __iter__(self):
+        for key in self._get_index():
+            yield key.decode('utf-8')
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __repr__(self):
+        return 'TagView({!r})'.format(self.raw_tags)
+
+    def to_dict(self):
+        """Decodes all tags, as returned by `decode_tags`."""
+        return {key: set(values) for key, values in self.items()}
+
+def _iter_header_chunks(file, size, chunk_size):
+    # Yields the tag block of a header whose size has just been read, at most
+    # `chunk_size` bytes at a time.
+    name = getattr(file, 'name', None)
+    if size != -1:
+        remaining = size
+        while remaining:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValueError(
+                    'polytaxis header in [{}] should be length {}, '
+                    'got length {}'
+                    .format(
+                        name,
+                        size,
+                        size - remaining,
+                    )
+                )
+            remaining -= len(chunk)
+            yield chunk
+        return
+    # The last bytes are held back in case they're the start of the mark
+    keep = len(unsized_mark) - 1
+    held = b''
+    total = 0
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            raise ValueError(
+                'Could not find end of tags in [{}]'.format(
+                    name
+                )
+            )
+        data = held + chunk
+        end = data.find(unsized_mark)
+        if end != -1:
+            if total + end > unsized_limit:
+                raise _unsized_too_long(name, unsized_limit)
+            yield data[:end]
+            return
+        split = max(0, len(data) - keep)
+        total += split
+        if total > unsized_limit:
+            raise _unsized_too_long(name, unsized_limit)
+        yield data[:split]
+        held = data[split:]
+
+def iter_tags(file, chunk_size=64 * 1024):
+    """Yields `(key, value)` for each tag in a file as it's decoded.
+
+    `file` is a filename or a binary file object.  The header is read
+    `chunk_size` bytes at a time, so memory use depends on the size of the
+    largest tag rather than of the header.  Repeated tags are yielded each
+    time they occur.  Nothing is yielded if the file has no header.
+    """
+    if not hasattr(file, 'read'):
+        with _open(file, 'rb') as opened:
+            for tag in iter_tags(opened, chunk_size):
+                yield tag
+        return
+    file.seek(0)
+    if not _read_magic(file):
+        return
+    size = _read_size(file)
+    chunks = _iter_header_chunks(file, size, chunk_size)
+    try:
+        for key, value in _stream_raw_tags(chunks):
+            yield (
+                key.decode('utf-8'),
+                value.decode('utf-8') if value is not None else None,
+            )
+    finally:
+        chunks.close()
+
+@_instrumented
+def get_tags(filename, probe_size=None, lazy=False, mmap=False):
+    """Gets tags from a file with a tag header, or returns None.
+
+    The start of the file is read with a single `probe_size` read (default
+    `polytaxis.default_probe_size`); headers that don't fit need one more read.
+    If `mmap`, the header is parsed from a memory mapping of the file instead.
+    If `lazy`, returns a `TagView` instead of decoding all the tags.
+    """
+    if mmap:
+        return _map_tags(filename, lazy)
+    with _open(filename, 'rb') as file:
+        if lazy:
+            raw_tags = _read_raw_tags(file, filename, _probe_size(probe_size))
+            return None if raw_tags is None else TagView(raw_tags)
+        return _read_tags(file, filename, _probe_size(probe_size))
+
+def get_tags_many(
+        paths,
+        workers=8,
+        ordered=False,
+        max_in_flight=None,
+        capture_errors=True,
+        probe_size=None):
+    """Gets tags for many files using a pool of `workers` threads.
+
+    Yields `(path, tags, error)` for each path, where `tags` is as returned by
+    `get_tags`.  Results are yielded as they complete unless `ordered`.  At
+    most `max_in_flight` reads (default `4 * workers`) are queued at once.  If
+    `capture_errors`, an `OSError` or `ValueError` reading a file is returned
+    as `error` (with `tags` None) rather than raised.
+    """
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+    max_in_flight = max(1, max_in_flight)
+
+    def read(path):
+        try:
+            return path, get_tags(path, probe_size=probe_size), None
+        except (OSError, ValueError) as e:
+            if not capture_errors:
+                raise
+            return path, None, e
+
+    paths = iter(paths)
+    end = object()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit():
+            path = next(paths, end)
+            if path is end:
+                return None
+            return pool.submit(read, path)
+
+        if ordered:
+            pending = collections.deque()
+            while True:
+                while len(pending) < max_in_flight:
+                    future = submit()
+                    if future is None:
+                        break
+                    pending.append(future)
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            while True:
+                while len(pending) < max_in_flight:
+                    future = submit()
+                    if future is None:
+                        break
+                    pending.add(future)
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    yield future.result()
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def _scan_entries(
+        root, include, exclude, follow_symlinks, onerror, min_size=len(magic)):
+    # Depth first with one open scandir iterator per level, so memory is
+    # bounded by the tree depth rather than the directory sizes.
+    visited = set()
+    if follow_symlinks:
+        stat = os.stat(root)
+        visited.add((stat.st_dev, stat.st_ino))
+    stack = [os.scandir(root)]
+    try:
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop().close()
+                continue
+            try:
+                if exclude and _matches(entry.name, exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if follow_symlinks:
+                        stat = entry.stat()
+                        key = (stat.st_dev, stat.st_ino)
+                        if key in visited:
+                            continue
+                        visited.add(key)
+                    stack.append(os.scandir(entry.path))
+                    continue
+                if not entry.is_file(follow_symlinks=follow_symlinks):
+                    continue
+                if include and not _matches(entry.name, include):
+                    continue
+                if min_size:
+                    stat = entry.stat(follow_symlinks=follow_symlinks)
+                    if stat.st_size < min_size:
+                        continue
+            except OSError as e:
+                if onerror is None:
+                    raise
+                onerror(e)
+                continue
+            yield entry
+    finally:
+        for iterator in stack:
+            iterator.close()
+
+def _advise_willneed(file, length):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(file.fileno(), 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+def scan(
+        root,
+        include=None,
+        exclude=None,
+        follow_symlinks=False,
+        onerror=None,
+        probe_size=None,
+        readahead=8):
+    """Walks `root` yielding `(path, tags)` for files with a tag header.
+
+    `include` and `exclude` are lists of glob patterns matched against file
+    and directory names.  Symbolic links are only followed if
+    `follow_symlinks`.  An `OSError` or `ValueError` is passed to `onerror` if
+    given, otherwise raised.  Up to `readahead` files are opened ahead of the
+    one being read, with a hint to the kernel to start fetching their headers.
+    """
+    probe_size = _probe_size(probe_size)
+    opened = collections.deque()
+
+    def handle(e):
+        if onerror is None:
+            raise e
+        onerror(e)
+
+    def finish():
+        path, file = opened.popleft()
+        try:
+            with file:
+                return path, _read_tags(file, path, probe_size)
+        except (OSError, ValueError) as e:
+            handle(e)
+            return path, None
+
+    try:
+        for entry in _scan_entries(
+                root, include, exclude, follow_symlinks, onerror):
+            path = entry.path
+            try:
+                file = _open(path, 'rb')
+            except OSError as e:
+                handle(e)
+                continue
+            opened.append((path, file))
+            _advise_willneed(file, probe_size)
+            if len(opened) > readahead:
+                path, tags = finish()
+                if tags is not None:
+                    yield path, tags
+        while opened:
+            path, tags = finish()
+            if tags is not None:
+                yield path, tags
+    finally:
+        for path, file in opened:
+            file.close()
+
+_caches = weakref.WeakSet()
+
+def _invalidate_caches(filename):
+    for cache in list(_caches):
+        cache.invalidate(filename)
+
+def _freeze_tags(tags):
+    if tags is None:
+        return None
+    return types.MappingProxyType(
+        {key: frozenset(values) for key, values in tags.items()}
+    )
+
+def _tags_weight(tags):
+    if tags is None:
+        return 1
+    return sum(
+        len(key) + sum(len(value or '') + 1 for value in values)
+        for key, values in tags.items()
+    )
+
+class TagCache(object):
+    """A memoizing, least-recently-used cache in front of `get_tags`.
+
+    Entries are keyed on the file's device, inode, size and modification time,
+    so changes made by other processes are noticed on the next lookup.
+    `set_tags` and `strip_tags` invalidate entries in all caches in this
+    process.  The cache holds at most `max_entries` files, and at most
+    roughly `max_bytes` of tag text if specified.
+
+    Cached tags are read-only mappings of frozensets; use `dict`/`set` to get
+    a modifiable copy.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        path, tags, weight = self._entries.pop(key)
+        self.bytes -= weight
+        if self._keys.get(path) == key:
+            del self._keys[path]
+
+    def invalidate(self, filename):
+        """Removes any entry for `filename`."""
+        path = os.path.abspath(filename)
+        with self._lock:
+            key = self._keys.get(path)
+            if key is not None:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.bytes = 0
+
+    def get_tags(self, filename, probe_size=None):
+        """As `get_tags`, but returns cached tags if the file is unchanged."""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == path:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        tags = _freeze_tags(get_tags(path, probe_size=probe_size))
+        weight = _tags_weight(tags)
+        with self._lock:
+            old_key = self._keys.get(path)
+            if old_key is not None:
+                self._drop(old_key)
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (path, tags, weight)
+            self._keys[path] = key
+            self.bytes += weight
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_entries or (
+                        self.max_bytes is not None and
+                        self.bytes > self.max_bytes)):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return tags
+
+def _shift_bit_length(x):
+    # http://stackoverflow.com/questions/14267555/how-can-i-find-the-smallest-power-of-2-greater-than-n-in-python  # noqa
+    return max(512, 1<<(x-1).bit_length())
+
+_falloc_fl_collapse_range = 0x08
+_falloc_fl_insert_range = 0x20
+_fallocate_function = None
+
+def _fallocate(fd, mode, offset, length):
+    """Calls Linux fallocate(2), returning False if it isn't supported for
+    this file or range."""
+    global _fallocate_function
+    if _fallocate_function is None:
+        _fallocate_function = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                function = getattr(libc, 'fallocate64', None)
+                if function is None:
+                    function = libc.fallocate
+            except (OSError, AttributeError):
+                pass
+            else:
+                function.argtypes = [
+                    ctypes.c_int,
+                    ctypes.c_int,
+                    ctypes.c_int64,
+                    ctypes.c_int64,
+                ]
+                function.restype = ctypes.c_int
+                _fallocate_function = function
+    if not _fallocate_function:
+        return False
+    return _fallocate_function(fd, mode, offset, length) == 0
+
+def _insert_range(file, length):
+    """Inserts `length` bytes at the start of `file` without moving the
+    payload, if the filesystem supports inserting a block aligned range."""
+    file.flush()
+    return _fallocate(file.fileno(), _falloc_fl_insert_range, 0, length)
+
+def _collapse_header(file):
+    """Removes the header before the current position of `file` without
+    moving the payload, if the header is block aligned and the filesystem
+    supports collapsing ranges."""
+    end = file.tell()
+    stat = os.fstat(file.fileno())
+    if end % stat.st_blksize != 0 or end >= stat.st_size:
+        return False
+    fd = os.open(file.name, os.O_RDWR)
+    try:
+        return _fallocate(fd, _falloc_fl_collapse_range, 0, end)
+    finally:
+        os.close(fd)
+
+def _aligned_header(raw_tags, minimize, align, policy):
+    header = io.BytesIO()
+    _write_tags(header, None, raw_tags, False, minimize, align, policy)
+    return header.getvalue()
+
+def _pwrite(file, data, offset):
+    os.pwrite(file.fileno(), data, offset)
+    if _stats is not None:
+        _stats._count(writes=1, bytes_written=len(data))
+
+def _copy_payload(file, file2):
+    """Appends the rest of `file` (from its current position) to `file2`.
+
+    Uses in-kernel copying (copy_file_range, which may reflink, or sendfile)
+    where supported, and falls back to copying through Python buffers.
+    """
+    file2.flush()
+    source = file.fileno()
+    dest = file2.fileno()
+    offset = file.tell()
+    dest_offset = file2.tell()
+    size = os.fstat(source).st_size
+    if _stats is not None:
+        _stats._count(bytes_copied=max(0, size - offset))
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(
+                    source, dest, size - offset, offset, dest_offset)
+                if not copied:
+                    return
+                offset += copied
+                dest_offset += copied
+            return
+        except OSError:
+            pass
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dest, dest_offset, os.SEEK_SET)
+            while offset < size:
+                sent = os.sendfile(dest, source, offset, size - offset)
+                if not sent:
+                    return
+                offset += sent
+                dest_offset += sent
+            return
+        except OSError:
+            pass
+    file.seek(offset)
+    file2.seek(dest_offset)
+    while True:
+        buffer = file.read(1024**2)
+        if not buffer:
+            break
+        file2.write(buffer)
+
+def _temp_beside(dest_name):
+    """Creates a temporary file in the same directory as `dest_name` so it can
+    be renamed over it atomically."""
+    directory, name = os.path.split(os.path.abspath(dest_name))
+    return tempfile.NamedTemporaryFile(
+        mode='wb',
+        dir=directory,
+        prefix='.{}.'.format(name),
+        suffix='.tmp',
+        delete=False,
+    )
+
+def _insert_tags(
+        raw_tags,
+        file,
+        dest_name,
+        unsized=False,
+        minimize=False,
+        align=None,
+        policy=None):
+    file2 = _counted(_temp_beside(dest_name))
+    try:
+        with file2:
+            write_tags(
+                file2, 
+                unsized=unsized, 
+                minimize=minimize, 
+                raw_tags=raw_tags,
+                align=align,
+                policy=policy,
+            )
+            _copy_payload(file, file2)
+            shutil.copymode(file.name, file2.name)
+        file.close()
+        if file.name != dest_name and os.path.exists(dest_name):
+            raise RuntimeError(
+                'Cannot add tags to [{}] because destination [{}] already '
+                'exists.'
+                .format(
+                    file.name,
+                    dest_name,
+                )
+            )
+        os.replace(file2.name, dest_name)
+    except:
+        os.unlink(file2.name)
+        raise
+
+@_instrumented
+def strip_tags(filename):
+    """Removes the tag header from a file."""
+    try:
+        _strip_tags(filename)
+    finally:
+        _invalidate_caches(filename)
+        if filename.endswith('.p'):
+            _invalidate_caches(filename[:-2])
+
+def _strip_tags(filename):
+    new_filename = filename
+    if filename.endswith('.p'):
+        new_filename = filename[:-2]
+        if os.path.exists(new_filename):
+            raise RuntimeError(
+                'Cannot strip [{}] because destination [{}] already exists.'
+                .format(
+                    filename,
+                    new_filename,
+                )
+            )
+    with _open(filename, 'rb') as file:
+        if not seek_past_tags(file):
+            raise RuntimeError(
+                'Could not find end of polytaxis data. File may be corrupt.'
+            )
+        if _collapse_header(file):
+            file.close()
+            if new_filename != filename:
+                os.rename(filename, new_filename)
+            return
+        file2 = _counted(_temp_beside(new_filename))
+        try:
+            with file2:
+                _copy_payload(file, file2)
+                shutil.copymode(filename, file2.name)
+            os.replace(file2.name, new_filename)
+        except:
+            os.unlink(file2.name)
+            raise
+    if new_filename != filename:
+        os.unlink(filename)
+
+def _iter_tag_pairs(tags):
+    for key, values in (tags or {}).items():
+        for value in values:
+            yield (
+                (
+                    key.encode('utf-8'),
+                    value.encode('utf-8') if value else None,
+                ),
+                key,
+                value,
+            )
+
+@_instrumented
+def update_tags(
+        filename,
+        add=None,
+        remove=None,
+        unsized=None,
+        minimize=False,
+        align=False,
+        policy=None):
+    """Adds and removes individual tags without re-encoding the header.
+
+    `add` and `remove` are tags in the `encode_tags` format; tags in both are
+    removed.  Existing tags are kept byte for byte and the header is edited in
+    place when the result fits in the existing sized header.  Nothing is
+    written if the tags don't change (and `unsized`, if specified, matches
+    the header type).  Otherwise see `set_tags`.  Returns the filename, which
+    changes if a header was added.
+    """
+    return _update_tags(
+        filename, add, remove, unsized, minimize, align, policy)[0]
+
+def _update_tags(filename, add, remove, unsized, minimize, align, policy):
+    # Returns the filename and the `header_stats` outcome
+    try:
+        return _edit_tags(
+            filename, add, remove, unsized, minimize, align, policy)
+    finally:
+        _invalidate_caches(filename)
+        _invalidate_caches('{}.p'.format(filename))
+
+def _edit_tags(filename, add, remove, unsized, minimize, align, policy):
+    remove = set(pair for pair, key, value in _iter_tag_pairs(remove))
+    with _open(filename, 'r+b') as file:
+        header = _read_header(file, filename, default_probe_size)
+        if header is None:
+            raw_tags, size, start = b'', None, None
+        else:
+            raw_tags, size, start = header
+        records = []
+        present = set()
+        changed = False
+        for record, pair in _iter_raw_records(raw_tags):
+            if pair in remove:
+                changed = True
+                continue
+            records.append(record)
+            present.add(pair)
+        for pair, key, value in _iter_tag_pairs(add):
+            if pair in remove or pair in present:
+                continue
+            records.append(encode_tag(key, value))
+            present.add(pair)
+            changed = True
+        convert = (
+            header is not None and
+            unsized is not None and
+            unsized != (size == -1)
+        )
+        if not changed and not convert:
+            header_stats._record(filename, 'unchanged')
+            return filename, 'unchanged'
+        records.append(b'')
+        raw_tags = sep2.join(records)
+        if size is not None and size != -1 and not unsized and (
+                len(raw_tags) <= size):
+            file.seek(start)
+            file.write(raw_tags)
+            if len(raw_tags) < size:
+                file.write(b'\0')
+            header_stats._record(filename, 'in_place')
+            return filename, 'in_place'
+    return _set_raw_tags(filename, raw_tags, unsized, minimize, align, policy)
+
+@_instrumented
+def set_tags(
+        filename,
+        tags,
+        unsized=None,
+        minimize=False,
+        align=False,
+        policy=None):
+    """Replaces or adds a tag header to a file.
+
+    If `align`, sized headers are padded to a multiple of the filesystem block
+    size so they can be added, grown and stripped without moving the payload on
+    filesystems that support it.  `policy` decides how much room new sized
+    headers get (see `growth_policy`).
+    """
+    try:
+        return _set_raw_tags(
+            filename, encode_tags(tags), unsized, minimize, align, policy)[0]
+    finally:
+        _invalidate_caches(filename)
+        _invalidate_caches('{}.p'.format(filename))
+
+def _set_raw_tags(filename, raw_tags, unsized, minimize, align, policy):
+    if len(raw_tags) > size_limit:
+        raise ValueError(
+            'encoded tags (length {}) are too long (max length {})'
+            .format(
+                len(raw_tags),
+                size_limit,
+            )
+        )
+    if policy is None:
+        policy = growth_policy(filename)
+    with _open(filename, 'r+b') as file:
+        if align:
+            align = os.fstat(file.fileno()).st_blksize
+        else:
+            align = None
+        if not _read_magic(file):
+            old_filename = filename
+            filename = '{}.p'.format(filename)
+            if align and not unsized:
+                if os.path.exists(filename):
+                    raise RuntimeError(
+                        'Cannot add tags to [{}] because destination [{}] '
+                        'already exists.'
+                        .format(
+                            old_filename,
+                            filename,
+                        )
+                    )
+                header = _aligned_header(raw_tags, minimize, align, policy)
+                if _insert_range(file, len(header)):
+                    _pwrite(file, header, 0)
+                    file.close()
+                    os.rename(old_filename, filename)
+                    header_stats._record(filename, 'insert_range')
+                    return filename, 'insert_range'
+            _insert_tags(
+                raw_tags, 
+                file, 
+                filename, 
+                unsized=unsized if unsized is not None else False,
+                minimize=minimize,
+                align=align,
+                policy=policy,
+            )
+            os.remove(old_filename)
+            header_stats._record(filename, 'rewrite')
+            return filename, 'rewrite'
+        size = _read_size(file)
+        if size == -1:
+            if _find_unsized_mark(file) is None:
+                raise ValueError(
+                    'Could not find end of tags in [{}]'.format(
+                        filename
+                    )
+                )
+            _insert_tags(
+                raw_tags, 
+                file, 
+                filename, 
+                unsized=unsized if unsized is not None else True,
+                minimize=minimize,
+                align=align,
+                policy=policy,
+            )
+            header_stats._record(filename, 'rewrite')
+            return filename, 'rewrite'
+        else:
+            end = _sized_header_end(size)
+            if size < len(raw_tags):
+                if align and not unsized and end % align == 0:
+                    header = _aligned_header(
+                        raw_tags, minimize, align, policy)
+                    if _insert_range(file, len(header) - end):
+                        _pwrite(file, header, 0)
+                        header_stats._record(filename, 'insert_range')
+                        return filename, 'insert_range'
+                file.seek(end)
+                _insert_tags(
+                    raw_tags, 
+                    file, 
+                    filename,
+                    unsized=unsized if unsized is not None else False,
+                    minimize=minimize,
+                    align=align,
+                    policy=policy,
+                )
+                header_stats._record(filename, 'rewrite')
+                return filename, 'rewrite'
+            if unsized == True:
+                file.seek(end)
+                _insert_tags(
+                    raw_tags, 
+                    file, 
+                    filename,
+                    unsized=True,
+                    minimize=minimize,
+                )
+                header_stats._record(filename, 'rewrite')
+                return filename, 'rewrite'
+            file.write(raw_tags)
+            if file.tell() < end:
+                file.write(b'\0')
+            header_stats._record(filename, 'in_place')
+    return filename, 'in_place'
+
+def seek_tags(file):
+    """Seek a file to the start of the tag header."""
+    target.seek(0)
+
+def seek_past_tags(file):
+    """Seek a file past the end of the tag header (start of non-tag data)."""
+    file.seek(0)
+    if not _read_magic(file):
+        file.seek(0)
+        return False
+    size = _read_size(file)
+    if size == -1:
+        if _find_unsized_mark(file) is None:
+            return False
+    else:
+        total = _sized_header_end(size)
+        file.seek(total, 0)
+        if file.tell() != total:
+            return False
+    return True
+
+class IncrementalHeaderParser(object):
+    """Parses a polytaxis header from data supplied in arbitrary chunks, such
+    as from a socket or pipe.
+
+    Pass each chunk to `feed`, which returns any payload (non-header) bytes
+    it contained.  Once `done` is true, `tagged` tells whether there was a
+    header, `tags` has the decoded tags (None if untagged) and
+    `payload_offset` is the offset of the payload in the stream.  Call
+    `close` at the end of the stream.  Unsized headers longer than `limit`
+    bytes (default `polytaxis.unsized_limit`) raise ValueError.
+    """
+    def __init__(self, limit=None):
+        self.limit = unsized_limit if limit is None else limit
+        self.tagged = None
+        self.unsized = None
+        self.size = None
+        self.raw_tags = None
+        self.tags = None
+        self.payload_offset = None
+        self._buffer = bytearray()
+        self._consumed = 0
+        self._remaining = None
+        self._terminated = False
+        self._search = 0
+
+    @property
+    def done(self):
+        return self.payload_offset is not None
+
+    def feed(self, data):
+        """Parses `data`, returning the part of it after the header."""
+        if self.done:
+            return bytes(data)
+        self._buffer += data
+        self._parse()
+        if not self.done:
+            return b''
+        payload = bytes(self._buffer)
+        self._buffer = bytearray()
+        return payload
+
+    def close(self):
+        """Signals the end of the stream, returning any bytes still held.
+
+        Raises ValueError if the stream ended inside a header.
+        """
+        if self.done:
+            return b''
+        if self.tagged is None:
+            # A prefix of the magic, too short to be a header
+            self.tagged = False
+            self.payload_offset = 0
+            payload = bytes(self._buffer)
+            self._buffer = bytearray()
+            return payload
+        raise ValueError('stream ends before end of polytaxis header')
+
+    def _finish(self, raw_tags):
+        self.raw_tags = bytes(raw_tags)
+        self.tags = decode_tags(self.raw_tags)
+        self.payload_offset = self._consumed
+
+    def _parse(self):
+        buffer = self._buffer
+        if self.tagged is None:
+            length = min(len(buffer), len(magic))
+            if buffer[:length] != magic[:length]:
+                self.tagged = False
+                self.payload_offset = 0
+                return
+            if length < len(magic):
+                return
+            self.tagged = True
+            del buffer[:len(magic)]
+            self._consumed += len(magic)
+        if self.unsized is None:
+            if not buffer:
+                return
+            needed = 2 if buffer[:1] == b'u' else 2 + size_size
+            if len(buffer) < needed:
+                return
+            self.size, end = _parse_size(buffer, 0, '<stream>')
+            self.unsized = self.size == -1
+            del buffer[:end]
+            self._consumed += end
+            self._remaining = self.size
+            self._raw_tags = bytearray()
+        if self.unsized:
+            end = buffer.find(unsized_mark, self._search)
+            if end == -1:
+                if len(buffer) - len(unsized_mark) + 1 > self.limit:
+                    raise _unsized_too_long('<stream>', self.limit)
+                self._search = max(0, len(buffer) - len(unsized_mark) + 1)
+                return
+            if end > self.limit:
+                raise _unsized_too_long('<stream>', self.limit)
+            raw_tags = buffer[:end]
+            del buffer[:end + len(unsized_mark)]
+            self._consumed += end + len(unsized_mark)
+            self._finish(raw_tags)
+            return
+        take = min(len(buffer), self._remaining)
+        if not self._terminated:
+            # Padding after the terminator isn't kept
+            end = buffer.find(b'\x00', 0, take)
+            if end != -1:
+                self._terminated = True
+                self._raw_tags += buffer[:end]
+            else:
+                self._raw_tags += buffer[:take]
+        del buffer[:take]
+        self._consumed += take
+        self._remaining -= take
+        if not self._remaining:
+            self._finish(self._raw_tags)
+            del self._raw_tags
+
+_unwrap_modes = {
+    'rb': 'rb',
+    'wb': 'rb+',
+    'ab': 'rb+',
+    'r+b': 'rb+',
+    'rb+': 'rb+',
+}
+
+class UnwrappedFile(io.RawIOBase):
+    """A raw binary file of just the payload of a polytaxis file (the whole
+    file if it has no header), so position 0 is the first byte after the
+    header.
+
+    `mode` is `rb`, `wb` (which doesn't truncate), `ab` or `r+b`.  Seeking
+    before the start of the payload seeks to its start.
+    """
+    def __init__(self, filename, mode='rb'):
+        super().__init__()
+        if mode not in _unwrap_modes:
+            raise ValueError('Unsupported mode {}'.format(mode))
+        self._file = open(filename, _unwrap_modes[mode], buffering=0)
+        try:
+            seek_past_tags(self._file)
+            self.offset = self._file.tell()
+            if mode == 'ab':
+                self._file.seek(0, os.SEEK_END)
+        except:
+            self._file.close()
+            raise
+        self.name = filename
+        self.mode = mode
+        self._readable = mode in ('rb', 'r+b', 'rb+')
+        self._writable = mode != 'rb'
+        self._append = mode == 'ab'
+
+    def readable(self):
+        return self._readable
+
+    def writable(self):
+        return self._writable
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        raise io.UnsupportedOperation(
+            'For safety reasons file descriptor access is disabled.',
+        )
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+    def readinto(self, buffer):
+        if not self._readable:
+            raise io.UnsupportedOperation('File not open for reading')
+        return self._file.readinto(buffer)
+
+    def readall(self):
+        if not self._readable:
+            raise io.UnsupportedOperation('File not open for reading')
+        return self._file.readall()
+
+    def write(self, data):
+        if not self._writable:
+            raise io.UnsupportedOperation('File not open for writing')
+        if self._append:
+            self._file.seek(0, os.SEEK_END)
+        return self._file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.tell() + offset
+        elif whence == os.SEEK_END:
+            position = (
+                os.fstat(self._file.fileno()).st_size - self.offset + offset
+            )
+        else:
+            raise ValueError('Invalid whence {}'.format(whence))
+        return self._file.seek(max(0, position) + self.offset) - self.offset
+
+    def tell(self):
+        return self._file.tell() - self.offset
+
+    def truncate(self, size=None):
+        if not self._writable:
+            raise io.UnsupportedOperation('File not open for writing')
+        if size is None:
+            size = self.tell()
+        self._file.truncate(max(0, size) + self.offset)
+        return max(0, size)
+
+def _map_payload(filename, mode):
+    if mode not in ('rb', 'r+b', 'rb+'):
+        raise ValueError('Unsupported mode {} for mmap'.format(mode))
+    mapping = _map_file(filename, mode != 'rb')
+    if mapping is None:
+        return memoryview(b'')
+    try:
+        header = _map_header(mapping, filename)
+    except:
+        mapping.close()
+        raise
+    return memoryview(mapping)[0 if header is None else header[3]:]
+
+def open_unwrap(filename, mode='rb', buffering=-1, mmap=False):
+    """Opens the payload of a polytaxis file, like `open` for a binary file.
+
+    Returns a buffered file (`io.BufferedReader`, `io.BufferedWriter` or
+    `io.BufferedRandom` depending on `mode`) wrapping an `UnwrappedFile`, or
+    the `UnwrappedFile` itself if `buffering` is 0.  See `UnwrappedFile` for
+    the modes.
+
+    If `mmap`, returns a `memoryview` of the payload in a memory mapping of
+    the file instead (writable if `mode` is `r+b`).  Releasing the view (for
+    example by using it in a `with` statement) unmaps the file.
+    """
+    if mmap:
+        return _map_payload(filename, mode)
+    raw = UnwrappedFile(filename, mode)
+    if buffering == 0:
+        return raw
+    try:
+        if buffering < 0:
+            buffering = max(
+                io.DEFAULT_BUFFER_SIZE,
+                os.fstat(raw._file.fileno()).st_blksize,
+            )
+        if raw.readable() and raw.writable():
+            return io.BufferedRandom(raw, buffering)
+        if raw.writable():
+            return io.BufferedWriter(raw, buffering)
+        return io.BufferedReader(raw, buffering)
+    except:
+        raw.close()
+        raise
+
+from .query import compile_query, match  # noqa: E402
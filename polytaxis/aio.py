@@ -0,0 +1,112 @@
+"""asyncio versions of the polytaxis file functions.
+
+Each call runs the corresponding `polytaxis` function on a shared thread pool,
+so they behave exactly like the synchronous versions (including `set_tags`
+renaming untagged files to `.p`).  The pool's size bounds how many files are
+accessed at once; change it with `configure`.
+
+Cancelling a call stops the caller waiting for it, but an operation that has
+already started on the pool runs to completion.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+import polytaxis
+
+default_max_workers = 8
+_executor = None
+_executor_lock = threading.Lock()
+
+def configure(max_workers=default_max_workers):
+    """Replaces the thread pool with one running at most `max_workers`
+    operations concurrently.  Operations already submitted still complete."""
+    global _executor
+    with _executor_lock:
+        old = _executor
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+        )
+    if old is not None:
+        old.shutdown(wait=False)
+
+def shutdown(wait=True):
+    """Shuts down the thread pool.  A new one is created on the next call."""
+    global _executor
+    with _executor_lock:
+        old = _executor
+        _executor = None
+    if old is not None:
+        old.shutdown(wait=wait)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=default_max_workers,
+            )
+        return _executor
+
+def _run(function, *args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(
+        _get_executor(),
+        functools.partial(function, *args, **kwargs),
+    )
+
+async def get_tags(filename, probe_size=None):
+    """See `polytaxis.get_tags`."""
+    return await _run(polytaxis.get_tags, filename, probe_size=probe_size)
+
+async def set_tags(
+        filename,
+        tags,
+        unsized=None,
+        minimize=False,
+        align=False,
+        policy=None):
+    """See `polytaxis.set_tags`.  Returns the new filename."""
+    return await _run(
+        polytaxis.set_tags,
+        filename,
+        tags,
+        unsized=unsized,
+        minimize=minimize,
+        align=align,
+        policy=policy,
+    )
+
+async def strip_tags(filename):
+    """See `polytaxis.strip_tags`."""
+    return await _run(polytaxis.strip_tags, filename)
+
+def _next_batch(iterator, lock, size):
+    with lock:
+        batch = []
+        for item in iterator:
+            batch.append(item)
+            if len(batch) >= size:
+                break
+        return batch
+
+def _close(iterator, lock):
+    with lock:
+        iterator.close()
+
+async def scan(root, batch_size=64, **kwargs):
+    """Asynchronously iterates `(path, tags)` as `polytaxis.scan`.
+
+    Results are fetched from the pool `batch_size` at a time.
+    """
+    iterator = polytaxis.scan(root, **kwargs)
+    lock = threading.Lock()
+    try:
+        while True:
+            batch = await _run(_next_batch, iterator, lock, batch_size)
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        _get_executor().submit(_close, iterator, lock)
@@ -0,0 +1,195 @@
+"""A persistent SQLite index of the tags of files in a directory tree."""
+import os
+import sqlite3
+
+from . import get_tags, _scan_entries
+
+_schema = '''
+create table if not exists files (
+    path text primary key,
+    inode integer not null,
+    size integer not null,
+    mtime_ns integer not null,
+    tagged integer not null,
+    generation integer not null
+);
+create table if not exists tags (
+    path text not null references files(path) on delete cascade,
+    key text not null,
+    value text
+);
+create index if not exists tags_path on tags(path);
+create index if not exists tags_key_value on tags(key, value);
+'''
+
+_any = object()
+
+class TagIndex(object):
+    """Records the tags of files under one or more roots in an SQLite
+    database at `filename`.
+
+    Call `refresh` to bring the index up to date; headers are only re-read for
+    files whose inode, size or modification time changed.
+    """
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('pragma foreign_keys = on')
+        with self.connection:
+            self.connection.executescript(_schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _store(self, cursor, path, stat, tags, generation):
+        cursor.execute('delete from tags where path = ?', (path,))
+        cursor.execute(
+            'insert or replace into files '
+            '(path, inode, size, mtime_ns, tagged, generation) '
+            'values (?, ?, ?, ?, ?, ?)',
+            (
+                path,
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                tags is not None,
+                generation,
+            ),
+        )
+        if tags:
+            cursor.executemany(
+                'insert into tags (path, key, value) values (?, ?, ?)',
+                (
+                    (path, key, value)
+                    for key, values in tags.items()
+                    for value in values
+                ),
+            )
+
+    def refresh(
+            self,
+            root,
+            include=None,
+            exclude=None,
+            follow_symlinks=False,
+            onerror=None):
+        """Indexes all files under `root`, re-reading headers only for files
+        that changed since the last refresh and dropping files that no longer
+        exist.  See `polytaxis.scan` for the other arguments.
+
+        Returns a dict with the number of files `read`, `unchanged` and
+        `removed`.
+        """
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, '')
+        counts = {'read': 0, 'unchanged': 0, 'removed': 0}
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute('select coalesce(max(generation), 0) from files')
+            generation = cursor.fetchone()[0] + 1
+            for entry in _scan_entries(
+                    root, include, exclude, follow_symlinks, onerror):
+                path = entry.path
+                try:
+                    stat = entry.stat(follow_symlinks=follow_symlinks)
+                except OSError as e:
+                    if onerror is None:
+                        raise
+                    onerror(e)
+                    continue
+                cursor.execute(
+                    'select inode, size, mtime_ns from files where path = ?',
+                    (path,),
+                )
+                row = cursor.fetchone()
+                if row == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                    cursor.execute(
+                        'update files set generation = ? where path = ?',
+                        (generation, path),
+                    )
+                    counts['unchanged'] += 1
+                    continue
+                try:
+                    tags = get_tags(path)
+                except (OSError, ValueError) as e:
+                    if onerror is None:
+                        raise
+                    onerror(e)
+                    continue
+                self._store(cursor, path, stat, tags, generation)
+                counts['read'] += 1
+            cursor.execute(
+                'delete from files '
+                'where substr(path, 1, ?) = ? and generation < ?',
+                (len(prefix), prefix, generation),
+            )
+            counts['removed'] = cursor.rowcount
+        return counts
+
+    def update(self, path, tags=_any):
+        """Re-reads the header of `path` (or records `tags` for it, in the
+        `get_tags` format) and stores it in the index, or drops `path` if it
+        no longer exists."""
+        path = os.path.abspath(path)
+        with self.connection:
+            cursor = self.connection.cursor()
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                cursor.execute('delete from files where path = ?', (path,))
+                return
+            if tags is _any:
+                tags = get_tags(path)
+            cursor.execute('select coalesce(max(generation), 0) from files')
+            generation = cursor.fetchone()[0]
+            self._store(cursor, path, stat, tags, generation)
+
+    def remove(self, path):
+        """Drops `path`, and everything under it if it's a directory, from
+        the index."""
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, '')
+        with self.connection:
+            self.connection.execute(
+                'delete from files where path = ? or substr(path, 1, ?) = ?',
+                (path, len(prefix), prefix),
+            )
+
+    def get(self, path):
+        """Returns the indexed tags of `path` in the `get_tags` format, or None
+        if it isn't indexed or has no header."""
+        cursor = self.connection.execute(
+            'select tagged from files where path = ?',
+            (os.path.abspath(path),),
+        )
+        row = cursor.fetchone()
+        if row is None or not row[0]:
+            return None
+        tags = {}
+        for key, value in self.connection.execute(
+                'select key, value from tags where path = ?',
+                (os.path.abspath(path),)):
+            tags.setdefault(key, set()).add(value)
+        return tags
+
+    def find(self, key, value=_any):
+        """Returns a sorted list of the paths of indexed files with the tag
+        `key`, or with the tag `key=value` if `value` is specified.  A `value`
+        of None matches valueless tags."""
+        if value is _any:
+            cursor = self.connection.execute(
+                'select distinct path from tags where key = ? order by path',
+                (key,),
+            )
+        else:
+            cursor = self.connection.execute(
+                'select distinct path from tags '
+                'where key = ? and value is ? order by path',
+                (key, value),
+            )
+        return [row[0] for row in cursor]
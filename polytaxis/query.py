@@ -0,0 +1,253 @@
+"""Boolean tag queries evaluated while a header is being decoded.
+
+A query is made of terms combined with `AND`, `OR`, `NOT` and parentheses, as
+in `author=rendaw AND NOT draft OR year=2015`.  `NOT` binds tightest, then
+`AND`, then `OR`.  A term `key` matches files with the tag `key` (with any or
+no value), `key=value` matches that value, and `key=` matches a value-less
+tag.  Special characters (whitespace, parentheses, `=` and `\\`) in keys and
+values are escaped with a backslash.
+
+Terms are compared against the raw tag bytes, so values are never decoded, and
+evaluation stops at the first tag that decides the result.
+"""
+from . import (
+    _iter_raw_tags,
+    _probe_size,
+    _read_raw_tags,
+    _scan_entries,
+)
+
+_any = object()
+_operators = ('AND', 'OR', 'NOT')
+
+def _tokenize(text):
+    tokens = []
+    index = 0
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char.isspace():
+            index += 1
+            continue
+        if char in '()':
+            tokens.append(char)
+            index += 1
+            continue
+        key = None
+        chars = []
+        escaped = False
+        while index < length:
+            char = text[index]
+            if char.isspace() or char in '()':
+                break
+            index += 1
+            if char == '\\':
+                escaped = True
+                if index < length:
+                    chars.append(text[index])
+                    index += 1
+            elif char == '=' and key is None:
+                key = ''.join(chars)
+                chars = []
+            else:
+                chars.append(char)
+        word = ''.join(chars)
+        if key is None:
+            if not escaped and word in _operators:
+                tokens.append(word)
+            else:
+                tokens.append((word, _any))
+        else:
+            tokens.append((key, word or None))
+    return tokens
+
+class Query(object):
+    """A compiled query; see the module documentation for the syntax."""
+    def __init__(self, text):
+        self.text = text
+        self._tokens = _tokenize(text)
+        self._position = 0
+        self._atoms = []
+        self._by_key = {}
+        if not self._tokens:
+            raise ValueError('Empty query')
+        self._tree = self._parse_or()
+        if self._position != len(self._tokens):
+            raise ValueError(
+                'Unexpected [{}] in query [{}]'.format(
+                    self._describe(self._tokens[self._position]),
+                    text,
+                )
+            )
+        del self._tokens
+
+    def __repr__(self):
+        return 'Query({!r})'.format(self.text)
+
+    def _describe(self, token):
+        if isinstance(token, tuple):
+            key, value = token
+            if value is _any:
+                return key
+            return '{}={}'.format(key, value or '')
+        return token
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of query [{}]'.format(self.text))
+        self._position += 1
+        return token
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._peek() == 'OR':
+            self._position += 1
+            children.append(self._parse_and())
+        if len(children) == 1:
+            return children[0]
+        return ('or', children)
+
+    def _parse_and(self):
+        children = [self._parse_not()]
+        while self._peek() == 'AND':
+            self._position += 1
+            children.append(self._parse_not())
+        if len(children) == 1:
+            return children[0]
+        return ('and', children)
+
+    def _parse_not(self):
+        token = self._next()
+        if token == 'NOT':
+            return ('not', self._parse_not())
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                raise ValueError(
+                    'Missing [)] in query [{}]'.format(self.text)
+                )
+            return node
+        if not isinstance(token, tuple):
+            raise ValueError(
+                'Unexpected [{}] in query [{}]'.format(token, self.text)
+            )
+        key, value = token
+        key = key.encode('utf-8')
+        if value is not None and value is not _any:
+            value = value.encode('utf-8')
+        index = len(self._atoms)
+        self._atoms.append((key, value))
+        self._by_key.setdefault(key, []).append((value, index))
+        return ('tag', index)
+
+    def _evaluate(self, node, state):
+        # Three-valued: None means not yet known
+        kind = node[0]
+        if kind == 'tag':
+            return state[node[1]]
+        if kind == 'not':
+            result = self._evaluate(node[1], state)
+            return None if result is None else not result
+        decisive = kind == 'or'
+        result = not decisive
+        for child in node[1]:
+            child_result = self._evaluate(child, state)
+            if child_result is decisive:
+                return decisive
+            if child_result is None:
+                result = None
+        return result
+
+    def _match_pairs(self, pairs):
+        state = [None] * len(self._atoms)
+        result = self._evaluate(self._tree, state)
+        if result is not None:
+            return result
+        by_key = self._by_key
+        for key, value in pairs:
+            candidates = by_key.get(key)
+            if candidates is None:
+                continue
+            changed = False
+            for want, index in candidates:
+                if state[index] is None and (want is _any or want == value):
+                    state[index] = True
+                    changed = True
+            if changed:
+                result = self._evaluate(self._tree, state)
+                if result is not None:
+                    return result
+        return self._evaluate(
+            self._tree,
+            [bool(found) for found in state],
+        )
+
+    def match_raw(self, raw_tags):
+        """Evaluates the query against an encoded tag block."""
+        return self._match_pairs(_iter_raw_tags(bytes(raw_tags)))
+
+    def match_tags(self, tags):
+        """Evaluates the query against decoded tags (see `encode_tags`)."""
+        return self._match_pairs(
+            (
+                key.encode('utf-8'),
+                value.encode('utf-8') if value else None,
+            )
+            for key, values in tags.items()
+            for value in values
+        )
+
+def compile_query(text):
+    """Parses `text` into a `Query`, raising ValueError if it's invalid."""
+    return Query(text)
+
+def match(path_or_bytes, query, probe_size=None):
+    """Returns whether the tags of a file match `query`.
+
+    `path_or_bytes` is either a filename or an encoded tag block (`bytes`).
+    `query` is a query string or a compiled `Query`.  Files without a
+    polytaxis header never match.
+    """
+    if not isinstance(query, Query):
+        query = Query(query)
+    if isinstance(path_or_bytes, (bytes, bytearray, memoryview)):
+        return query.match_raw(path_or_bytes)
+    with open(path_or_bytes, 'rb') as file:
+        raw_tags = _read_raw_tags(file, path_or_bytes, _probe_size(probe_size))
+    if raw_tags is None:
+        return False
+    return query.match_raw(raw_tags)
+
+def find(
+        root,
+        query,
+        include=None,
+        exclude=None,
+        follow_symlinks=False,
+        onerror=None,
+        probe_size=None):
+    """Walks `root` yielding the paths of files whose tags match `query`.
+
+    See `polytaxis.scan` for the other arguments.
+    """
+    if not isinstance(query, Query):
+        query = Query(query)
+    probe_size = _probe_size(probe_size)
+    for entry in _scan_entries(
+            root, include, exclude, follow_symlinks, onerror):
+        try:
+            with open(entry.path, 'rb') as file:
+                raw_tags = _read_raw_tags(file, entry.path, probe_size)
+        except (OSError, ValueError) as e:
+            if onerror is None:
+                raise
+            onerror(e)
+            continue
+        if raw_tags is not None and query.match_raw(raw_tags):
+            yield entry.path
@@ -0,0 +1,178 @@
+"""A compact in-memory store of the tags of many files.
+
+Keys and values are interned in pools shared by all files, and each file's
+tags are kept as a sorted `array` of integers, one per tag, combining the key
+and value ids.  Identical tag sets share one array while any file uses it.
+This takes a fraction of the memory of a `get_tags` dict per file.
+"""
+import array
+import bisect
+import weakref
+
+_any = object()
+_value_bits = 32
+_value_mask = (1 << _value_bits) - 1
+
+class TagStore(object):
+    """Maps file paths to their tags.
+
+    Add files with `add` or `load`, and get a file's tags back in the
+    `get_tags` format with `get`.
+    """
+    def __init__(self):
+        self._key_ids = {}
+        self._keys = []
+        self._value_ids = {None: 0}
+        self._values = [None]
+        self._files = {}
+        # Hash of the codes to the array shared by files with those tags
+        self._shared = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __getitem__(self, path):
+        return self._decode(self._files[path])
+
+    def __delitem__(self, path):
+        del self._files[path]
+
+    def _intern(self, ids, strings, string):
+        id = ids.get(string)
+        if id is None:
+            id = len(strings)
+            if id > _value_mask:
+                raise ValueError('Too many distinct tag keys or values')
+            ids[string] = id
+            strings.append(string)
+        return id
+
+    def _encode(self, tags):
+        codes = sorted(
+            self._intern(self._key_ids, self._keys, key) << _value_bits |
+            self._intern(self._value_ids, self._values, value)
+            for key, values in tags.items()
+            for value in values
+        )
+        codes = array.array('Q', codes)
+        key = hash(codes.tobytes())
+        shared = self._shared.get(key)
+        if shared is None:
+            self._shared[key] = codes
+        elif shared == codes:
+            return shared
+        return codes
+
+    def _decode(self, codes):
+        tags = {}
+        keys = self._keys
+        values = self._values
+        for code in codes:
+            tags.setdefault(keys[code >> _value_bits], set()).add(
+                values[code & _value_mask]
+            )
+        return tags
+
+    def add(self, path, tags):
+        """Stores `tags` (in the `encode_tags` format) for `path`, replacing
+        any stored before.  `None` tags remove `path`."""
+        if tags is None:
+            self._files.pop(path, None)
+            return
+        self._files[path] = self._encode(tags)
+
+    def load(self, results):
+        """Adds the `(path, tags)` pairs yielded by `polytaxis.scan` or the
+        `(path, tags, error)` tuples yielded by `polytaxis.get_tags_many`.
+        Files without tags (or that failed) are skipped.  Returns the number
+        of files added."""
+        count = 0
+        for result in results:
+            path, tags = result[0], result[1]
+            if tags is None:
+                continue
+            self._files[path] = self._encode(tags)
+            count += 1
+        return count
+
+    def get(self, path, default=None):
+        """Returns the tags of `path` in the `get_tags` format, or `default`
+        if it isn't stored."""
+        codes = self._files.get(path)
+        if codes is None:
+            return default
+        return self._decode(codes)
+
+    def has_tag(self, path, key, value=_any):
+        """Returns whether `path` has the tag `key`, or `key=value` if `value`
+        is specified (None for a valueless tag)."""
+        codes = self._files.get(path)
+        key_id = self._key_ids.get(key)
+        if codes is None or key_id is None:
+            return False
+        if value is _any:
+            index = bisect.bisect_left(codes, key_id << _value_bits)
+            return (
+                index < len(codes) and codes[index] >> _value_bits == key_id
+            )
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            return False
+        code = key_id << _value_bits | value_id
+        index = bisect.bisect_left(codes, code)
+        return index < len(codes) and codes[index] == code
+
+    def keys(self, path=None):
+        """Returns a list of the keys of `path`, or of all keys in the store
+        if `path` is None."""
+        if path is None:
+            return list(self._keys)
+        keys = []
+        last = None
+        for code in self._files[path]:
+            key_id = code >> _value_bits
+            if key_id != last:
+                keys.append(self._keys[key_id])
+                last = key_id
+        return keys
+
+    def find(self, key, value=_any):
+        """Yields the paths of files with the tag `key`, or `key=value` if
+        `value` is specified."""
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            return
+        if value is not _any and value not in self._value_ids:
+            return
+        matches = {}
+        for path, codes in self._files.items():
+            match = matches.get(id(codes))
+            if match is None:
+                match = matches[id(codes)] = self.has_tag(path, key, value)
+            if match:
+                yield path
+
+    def compact(self):
+        """Drops keys and values no longer used by any stored file from the
+        pools.  Takes time proportional to the size of the store."""
+        decoded = {}
+        for codes in self._files.values():
+            if id(codes) not in decoded:
+                decoded[id(codes)] = (codes, self._decode(codes))
+        self._key_ids = {}
+        self._keys = []
+        self._value_ids = {None: 0}
+        self._values = [None]
+        self._shared = weakref.WeakValueDictionary()
+        encoded = {}
+        for path, codes in self._files.items():
+            new = encoded.get(id(codes))
+            if new is None:
+                new = encoded[id(codes)] = self._encode(decoded[id(codes)][1])
+            self._files[path] = new
@@ -0,0 +1,412 @@
+"""Watching a directory tree for tag changes.
+
+`Watcher` reports files under a directory whose tags may have changed, using
+Linux inotify where available and otherwise comparing periodic scans of the
+tree.  Bursts of events for a file are merged: a file is re-read with
+`get_tags` once no events for it have arrived for `debounce` seconds.  `watch`
+can also apply the changes to a `polytaxis.index.TagIndex`.
+"""
+import collections
+import ctypes
+import os
+import select
+import struct
+import sys
+import time
+
+from . import get_tags, _matches, _scan_entries
+
+Event = collections.namedtuple('Event', ['kind', 'path', 'tags'])
+Event.__doc__ = """A change reported by a `Watcher`.
+
+`kind` is `changed` (the file was written, created or renamed into place;
+`tags` holds its tags as returned by `get_tags`), `removed` (the file was
+deleted or renamed away), `removed_tree` (the directory `path` and everything
+in it was deleted or renamed away) or `rescan` (events were lost, so anything
+under `path` may have changed).
+"""
+
+_in_close_write = 0x00000008
+_in_moved_from = 0x00000040
+_in_moved_to = 0x00000080
+_in_create = 0x00000100
+_in_delete = 0x00000200
+_in_q_overflow = 0x00004000
+_in_ignored = 0x00008000
+_in_onlydir = 0x01000000
+_in_dont_follow = 0x02000000
+_in_isdir = 0x40000000
+_event_header = struct.Struct('iIII')
+_libc = None
+
+def _inotify():
+    """Returns libc if it supports inotify, otherwise None."""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [
+                    ctypes.c_int,
+                    ctypes.c_char_p,
+                    ctypes.c_uint32,
+                ]
+                libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            except (OSError, AttributeError):
+                pass
+            else:
+                _libc = libc
+    return _libc or None
+
+def _errno_error(path=None):
+    error = ctypes.get_errno()
+    return OSError(error, os.strerror(error), path)
+
+class Watcher(object):
+    """Watches the tree at `root` for files whose tags may have changed.
+
+    Call `poll` to wait for `Event`s, or iterate over the watcher to get them
+    as they happen.  Changes made before the watcher was created aren't
+    reported.
+
+    `backend` is `inotify` or `poll` (default: `inotify` where supported).
+    The `poll` backend rescans the tree every `interval` seconds.  See
+    `polytaxis.scan` for the other arguments.
+    """
+    def __init__(
+            self,
+            root,
+            include=None,
+            exclude=None,
+            follow_symlinks=False,
+            onerror=None,
+            debounce=0.1,
+            interval=2.0,
+            backend=None):
+        self.root = os.path.abspath(root)
+        self.include = include
+        self.exclude = exclude
+        self.follow_symlinks = follow_symlinks
+        self.onerror = onerror
+        self.debounce = debounce
+        self.interval = interval
+        if backend is None:
+            backend = 'inotify' if _inotify() else 'poll'
+        if backend not in ('inotify', 'poll'):
+            raise ValueError('Unknown watch backend [{}]'.format(backend))
+        self.backend = backend
+        # Path to kind and deadline, in deadline order
+        self._pending = collections.OrderedDict()
+        self._fd = None
+        self._closed = False
+        if backend == 'inotify':
+            libc = _inotify()
+            if libc is None:
+                raise OSError('inotify is not supported on this system')
+            self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if self._fd < 0:
+                self._fd = None
+                raise _errno_error()
+            self._wds = {}
+            self._paths = {}
+            try:
+                self._add_tree(self.root, False)
+            except:
+                self.close()
+                raise
+        else:
+            self._snapshot = self._take_snapshot()
+            self._next_scan = time.monotonic() + interval
+
+    def close(self):
+        self._closed = True
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            for event in self.poll():
+                yield event
+
+    def _error(self, e):
+        if self.onerror is None:
+            raise e
+        self.onerror(e)
+
+    def _queue(self, path, kind):
+        previous = self._pending.pop(path, None)
+        previous_kind = None if previous is None else previous[0]
+        if previous_kind == 'created':
+            if kind == 'removed':
+                # Created and removed again, such as a temporary file
+                return
+            if kind == 'changed':
+                kind = 'created'
+        elif kind == 'created' and previous_kind is not None:
+            kind = 'changed'
+        if kind == 'removed_tree':
+            prefix = os.path.join(path, '')
+            for other in [
+                    other for other in self._pending
+                    if other.startswith(prefix)]:
+                del self._pending[other]
+        self._pending[path] = (kind, time.monotonic() + self.debounce)
+
+    def _resolve(self, path, kind):
+        if kind in ('rescan', 'removed_tree'):
+            return Event(kind, path, None)
+        if kind == 'removed' and not os.path.lexists(path):
+            return Event('removed', path, None)
+        if not self.follow_symlinks and os.path.islink(path):
+            return None
+        try:
+            return Event('changed', path, get_tags(path))
+        except FileNotFoundError:
+            return Event('removed', path, None)
+        except IsADirectoryError:
+            return None
+        except (OSError, ValueError) as e:
+            self._error(e)
+            return None
+
+    def _flush(self, now):
+        events = []
+        while self._pending:
+            path, (kind, deadline) = next(iter(self._pending.items()))
+            if deadline > now:
+                break
+            del self._pending[path]
+            event = self._resolve(path, kind)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def poll(self, timeout=None):
+        """Waits up to `timeout` seconds (forever if None) for changes and
+        returns a list of `Event`s, which is empty if the time ran out."""
+        if self._closed:
+            raise ValueError('Watcher is closed')
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            events = self._flush(now)
+            if events:
+                return events
+            wait = None
+            if self._pending:
+                wait = next(iter(self._pending.values()))[1] - now
+            if self._fd is None:
+                scan = self._next_scan - now
+                wait = scan if wait is None else min(wait, scan)
+            if end is not None:
+                if now >= end:
+                    return []
+                wait = end - now if wait is None else min(wait, end - now)
+            self._wait(None if wait is None else max(0, wait))
+
+    def _wait(self, timeout):
+        if self._fd is None:
+            if timeout:
+                time.sleep(timeout)
+            if time.monotonic() >= self._next_scan:
+                self._scan()
+                self._next_scan = time.monotonic() + self.interval
+            return
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            self._read_events()
+
+    # Polling
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for entry in _scan_entries(
+                self.root,
+                self.include,
+                self.exclude,
+                self.follow_symlinks,
+                self.onerror,
+                min_size=0):
+            try:
+                stat = entry.stat(follow_symlinks=self.follow_symlinks)
+            except OSError as e:
+                self._error(e)
+                continue
+            snapshot[entry.path] = (
+                stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _scan(self):
+        snapshot = self._take_snapshot()
+        for path, key in snapshot.items():
+            if self._snapshot.get(path) != key:
+                self._queue(path, 'changed')
+        for path in self._snapshot:
+            if path not in snapshot:
+                self._queue(path, 'removed')
+        self._snapshot = snapshot
+
+    # inotify
+
+    def _add_watch(self, directory):
+        mask = (
+            _in_close_write |
+            _in_moved_from |
+            _in_moved_to |
+            _in_create |
+            _in_delete |
+            _in_onlydir
+        )
+        if not self.follow_symlinks:
+            mask |= _in_dont_follow
+        wd = _libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), mask)
+        if wd < 0:
+            self._error(_errno_error(directory))
+            return False
+        if wd in self._wds:
+            # Already watched through another path (a symlink loop)
+            return False
+        self._wds[wd] = directory
+        self._paths[directory] = wd
+        return True
+
+    def _add_tree(self, directory, report):
+        def onerror(e):
+            self._error(e)
+        for parent, dirs, files in os.walk(
+                directory,
+                onerror=onerror,
+                followlinks=self.follow_symlinks):
+            if not self._add_watch(parent):
+                dirs[:] = []
+                continue
+            if self.exclude:
+                dirs[:] = [
+                    name for name in dirs
+                    if not _matches(name, self.exclude)
+                ]
+            if not report:
+                continue
+            for name in files:
+                if self.exclude and _matches(name, self.exclude):
+                    continue
+                if self.include and not _matches(name, self.include):
+                    continue
+                self._queue(os.path.join(parent, name), 'changed')
+
+    def _remove_tree(self, directory):
+        prefix = os.path.join(directory, '')
+        for path, wd in list(self._paths.items()):
+            if path == directory or path.startswith(prefix):
+                _libc.inotify_rm_watch(self._fd, wd)
+                del self._paths[path]
+                del self._wds[wd]
+        self._queue(directory, 'removed_tree')
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & _in_q_overflow:
+            self._queue(self.root, 'rescan')
+            return
+        directory = self._wds.get(wd)
+        if mask & _in_ignored:
+            if directory is not None:
+                del self._wds[wd]
+                del self._paths[directory]
+            return
+        if directory is None or not name:
+            return
+        if self.exclude and _matches(name, self.exclude):
+            return
+        path = os.path.join(directory, name)
+        if mask & _in_isdir:
+            if mask & (_in_create | _in_moved_to):
+                self._add_tree(path, True)
+            elif mask & (_in_delete | _in_moved_from):
+                self._remove_tree(path)
+            return
+        if self.include and not _matches(name, self.include):
+            return
+        if mask & (_in_delete | _in_moved_from):
+            self._queue(path, 'removed')
+        elif mask & _in_create:
+            self._queue(path, 'created')
+        else:
+            self._queue(path, 'changed')
+
+def _apply(watcher, index, refresh):
+    with watcher:
+        for event in watcher:
+            if index is not None:
+                if event.kind == 'changed':
+                    index.update(event.path, event.tags)
+                elif event.kind == 'rescan':
+                    refresh()
+                else:
+                    index.remove(event.path)
+            yield event
+
+def watch(
+        root,
+        index=None,
+        include=None,
+        exclude=None,
+        follow_symlinks=False,
+        onerror=None,
+        debounce=0.1,
+        interval=2.0,
+        backend=None):
+    """Starts watching the tree at `root`, returning an iterator of `Event`s;
+    see `Watcher`.
+
+    If `index` (a `polytaxis.index.TagIndex`) is specified it's refreshed
+    before returning, then each event is applied to it before being yielded.
+    """
+    watcher = Watcher(
+        root,
+        include=include,
+        exclude=exclude,
+        follow_symlinks=follow_symlinks,
+        onerror=onerror,
+        debounce=debounce,
+        interval=interval,
+        backend=backend,
+    )
+
+    def refresh():
+        index.refresh(
+            watcher.root,
+            include=include,
+            exclude=exclude,
+            follow_symlinks=follow_symlinks,
+            onerror=onerror,
+        )
+    if index is not None:
+        try:
+            refresh()
+        except:
+            watcher.close()
+            raise
+    return _apply(watcher, index, refresh)
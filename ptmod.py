@@ -1,6 +1,17 @@
 """A utility to display and modify polytaxis metadata."""
 import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+
 import polytaxis
+import polytaxis.index
+import polytaxis.query
+import polytaxis.watch
 
 def minmax_append_action(nmin, nmax):
     class Inner(argparse.Action):
@@ -16,10 +27,398 @@ def minmax_append_action(nmin, nmax):
             getattr(args, self.dest).append(values)
     return Inner
 
+def find_main(argv):
+    """Print files matching a tag query."""
+    parser = argparse.ArgumentParser(
+        prog='ptmod find',
+        description='Find files whose polytaxis tags match a query, such as'
+        ' \'author=rendaw AND NOT draft OR year=2015\'.',
+    )
+    parser.add_argument(
+        'query',
+        help='Query to match.',
+    )
+    parser.add_argument(
+        'path',
+        help='Directories to search (default: current directory).',
+        nargs='*',
+    )
+    parser.add_argument(
+        '-0',
+        '--null',
+        help='Separate output paths with NUL characters.',
+        action='store_true',
+    )
+    args = parser.parse_args(argv)
+    try:
+        query = polytaxis.compile_query(args.query)
+    except ValueError as e:
+        parser.error(str(e))
+    failed = []
+
+    def onerror(e):
+        failed.append(e)
+        print('Error: {}'.format(e), file=sys.stderr)
+
+    end = '\0' if args.null else '\n'
+    for root in args.path or ['.']:
+        try:
+            for path in polytaxis.query.find(root, query, onerror=onerror):
+                print(path, end=end)
+        except OSError as e:
+            onerror(e)
+    if failed:
+        sys.exit(1)
+
+def parse_rate(text):
+    """Parses a byte rate such as `500K` or `20M` (per second)."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = units.get(text[-1:].upper())
+    if multiplier is not None:
+        text = text[:-1]
+    else:
+        multiplier = 1
+    try:
+        rate = float(text) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid rate [{}]'.format(text))
+    if rate <= 0:
+        raise argparse.ArgumentTypeError('rate must be positive')
+    return rate
+
+class RateLimiter(object):
+    """Spaces out work so at most `rate` bytes per second are processed,
+    across all threads."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+def header_kind(filename):
+    """Returns `sized`, `unsized` or None if the file has no header."""
+    with open(filename, 'rb') as file:
+        start = file.read(len(polytaxis.magic) + 1)
+    if start[:len(polytaxis.magic)] != polytaxis.magic:
+        return None
+    return 'unsized' if start[len(polytaxis.magic):] == b'u' else 'sized'
+
+def read_journal(filename):
+    """Returns the set of paths recorded as converted in a journal."""
+    done = set()
+    try:
+        with open(filename, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partly written when the last run was interrupted
+                    continue
+                if entry.get('outcome') != 'failed':
+                    done.add(entry['path'])
+    except FileNotFoundError:
+        pass
+    return done
+
+def plan_migration(roots, target, done, onerror):
+    """Walks `roots`, returning the files that need converting to `target`
+    and counts of the files that don't."""
+    plan = []
+    counts = collections.Counter()
+    for root in roots:
+        if os.path.isdir(root):
+            filenames = (
+                os.path.join(directory, name)
+                for directory, dirs, files in os.walk(root, onerror=onerror)
+                for name in sorted(files)
+            )
+        else:
+            filenames = [root]
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            if filename in done:
+                counts['journaled'] += 1
+                continue
+            try:
+                kind = header_kind(filename)
+                size = os.path.getsize(filename)
+            except OSError as e:
+                onerror(e)
+                counts['failed'] += 1
+                continue
+            if kind is None:
+                counts['untagged'] += 1
+            elif kind == target:
+                counts['converted already'] += 1
+            else:
+                plan.append((filename, size))
+    return plan, counts
+
+def migrate_file(filename, size, args, limiter):
+    """Converts one file, returning a journal entry for it."""
+    if limiter is not None:
+        limiter.acquire(size)
+    try:
+        filename, outcome = polytaxis._update_tags(
+            filename,
+            None,
+            None,
+            args.to == 'unsized',
+            args.minimize,
+            args.align,
+            None,
+        )
+        if outcome == 'rewrite':
+            written = os.path.getsize(filename)
+        elif outcome == 'unchanged':
+            written = 0
+        else:
+            with open(filename, 'rb') as file:
+                polytaxis.seek_past_tags(file)
+                written = file.tell()
+    except (OSError, ValueError, RuntimeError) as e:
+        return {'path': filename, 'outcome': 'failed', 'error': str(e)}
+    return {'path': filename, 'outcome': outcome, 'bytes': written}
+
+def migrate_main(argv):
+    """Convert headers between sized and unsized across a tree."""
+    parser = argparse.ArgumentParser(
+        prog='ptmod migrate',
+        description='Convert the headers of all tagged files in directories'
+        ' to sized or unsized headers.',
+    )
+    parser.add_argument(
+        'path',
+        help='Files and directories to convert.',
+        nargs='+',
+    )
+    parser.add_argument(
+        '--to',
+        help='Header type to convert to.',
+        choices=('sized', 'unsized'),
+        required=True,
+    )
+    parser.add_argument(
+        '--minimize',
+        help='Don\'t leave room to grow in sized headers.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--align',
+        help='Pad sized headers to the filesystem block size.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of files to convert in parallel.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--bwlimit',
+        help='Limit conversions to this many bytes per second, with an'
+        ' optional K, M or G suffix.',
+        type=parse_rate,
+    )
+    parser.add_argument(
+        '--journal',
+        help='Record converted files in this file, and skip files already'
+        ' recorded in it.',
+    )
+    parser.add_argument(
+        '-n',
+        '--dry-run',
+        help='Only print what would be converted.',
+        action='store_true',
+    )
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('-j/--jobs must be at least 1.')
+
+    failed = []
+
+    def onerror(e):
+        failed.append(e)
+        print('Error: {}'.format(e), file=sys.stderr)
+
+    done = read_journal(args.journal) if args.journal else set()
+    plan, counts = plan_migration(args.path, args.to, done, onerror)
+    print(
+        '{} files ({} bytes) to convert to {}; {}'.format(
+            len(plan),
+            sum(size for filename, size in plan),
+            args.to,
+            ', '.join(
+                '{} {}'.format(count, name)
+                for name, count in sorted(counts.items())
+            ) or 'nothing else found',
+        ),
+        file=sys.stderr,
+    )
+    if args.dry_run:
+        for filename, size in plan:
+            print(filename)
+        return
+
+    limiter = None if args.bwlimit is None else RateLimiter(args.bwlimit)
+    journal = (
+        open(args.journal, 'a', encoding='utf-8') if args.journal else None
+    )
+    if journal is not None and journal.tell():
+        # The last line may be incomplete if the last run was interrupted
+        journal.write('\n')
+    totals = collections.Counter()
+    start = time.time()
+    try:
+        for entry in map_ordered(
+                lambda item: migrate_file(item[0], item[1], args, limiter),
+                plan,
+                args.jobs):
+            totals[entry['outcome']] += 1
+            if entry['outcome'] == 'failed':
+                print(
+                    'Error converting [{}]: {}'.format(
+                        entry['path'], entry['error']),
+                    file=sys.stderr,
+                )
+            elif entry['outcome'] == 'rewrite':
+                totals['bytes rewritten'] += entry['bytes']
+            else:
+                totals['bytes in place'] += entry['bytes']
+            if journal is not None:
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+    finally:
+        if journal is not None:
+            journal.close()
+    print(
+        '{} rewritten ({} bytes), {} edited in place ({} bytes), {} '
+        'unchanged, {} failed in {:.2f}s'.format(
+            totals['rewrite'],
+            totals['bytes rewritten'],
+            totals['in_place'] + totals['insert_range'],
+            totals['bytes in place'],
+            totals['unchanged'],
+            totals['failed'],
+            time.time() - start,
+        ),
+        file=sys.stderr,
+    )
+    if failed or totals['failed']:
+        sys.exit(1)
+
+def watch_main(argv):
+    """Print tag changes in a tree as they happen."""
+    parser = argparse.ArgumentParser(
+        prog='ptmod watch',
+        description='Watch a directory for files whose polytaxis tags change'
+        ' and print each change as a line of JSON.',
+    )
+    parser.add_argument(
+        'path',
+        help='Directory to watch (default: current directory).',
+        nargs='?',
+        default='.',
+    )
+    parser.add_argument(
+        '--index',
+        help='Keep the tag index database at this path up to date.',
+    )
+    parser.add_argument(
+        '--include',
+        help='Only watch files whose names match this pattern.'
+        ' May be specified multiple times.',
+        action='append',
+    )
+    parser.add_argument(
+        '--exclude',
+        help='Ignore files and directories whose names match this pattern.'
+        ' May be specified multiple times.',
+        action='append',
+    )
+    parser.add_argument(
+        '-L',
+        '--follow-symlinks',
+        help='Follow symbolic links.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--debounce',
+        help='Seconds to wait for a file to stop changing before reading it.',
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        '--poll',
+        help='Rescan the tree periodically instead of using inotify.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--interval',
+        help='Seconds between rescans with --poll.',
+        type=float,
+        default=2.0,
+    )
+    args = parser.parse_args(argv)
+
+    def onerror(e):
+        print('Error: {}'.format(e), file=sys.stderr)
+
+    index = None if args.index is None else polytaxis.index.TagIndex(
+        args.index)
+    try:
+        events = polytaxis.watch.watch(
+            args.path,
+            index=index,
+            include=args.include,
+            exclude=args.exclude,
+            follow_symlinks=args.follow_symlinks,
+            onerror=onerror,
+            debounce=args.debounce,
+            interval=args.interval,
+            backend='poll' if args.poll else None,
+        )
+        try:
+            for event in events:
+                print(json.dumps({
+                    'event': event.kind,
+                    'path': event.path,
+                    'tags': None if event.tags is None else {
+                        key: sorted(values, key=lambda value: (
+                            value is not None, value or ''))
+                        for key, values in event.tags.items()
+                    },
+                }))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            events.close()
+    finally:
+        if index is not None:
+            index.close()
+
 def main():
     """List and modify tags."""
+    if sys.argv[1:2] == ['find']:
+        return find_main(sys.argv[2:])
+    if sys.argv[1:2] == ['migrate']:
+        return migrate_main(sys.argv[2:])
+    if sys.argv[1:2] == ['watch']:
+        return watch_main(sys.argv[2:])
     parser = argparse.ArgumentParser(
-        description='Modify polytaxis metadata on a file.',
+        description='Modify polytaxis metadata on a file.'
+        ' Run \'ptmod find -h\' for help searching by tags,'
+        ' \'ptmod migrate -h\' for help converting header types, or'
+        ' \'ptmod watch -h\' for help watching for tag changes.',
     )
     parser.add_argument(
         'file', 
@@ -73,8 +472,40 @@ def main():
         dest='list', 
         action='store_true',
     )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of files to process in parallel.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--from-file',
+        help='Read additional file paths from this file, one per line'
+        ' (\'-\' for stdin).',
+    )
+    parser.add_argument(
+        '-0',
+        '--null',
+        help='Paths read with --from-file are separated by NUL characters.'
+        ' Reads from stdin if --from-file isn\'t specified.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '-R',
+        '--recursive',
+        help='Process all files in directories, recursively.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--stats',
+        help='Print I/O statistics to stderr when done.',
+        action='store_true',
+    )
     parser.set_defaults(list=False, strip=False, add=[], remove=[])
     args = parser.parse_args()
+    if args.null and args.from_file is None:
+        args.from_file = '-'
     if not args.add and not args.remove and not args.empty and not args.strip:
         args.list = True
 
@@ -94,46 +525,163 @@ def main():
             'You cannot use any other options with -s/--strip.'
         )
 
+    if args.jobs < 1:
+        parser.error('-j/--jobs must be at least 1.')
+
+    if args.stats:
+        polytaxis.enable_stats()
+    counts = collections.Counter()
+    start = time.time()
+    for filename, status, output in run(
+            iterate_files(args), args, unsized, args.jobs):
+        counts[status] += 1
+        if output is not None:
+            print(
+                output,
+                file=sys.stdout if status == 'processed' else sys.stderr,
+            )
+    total = sum(counts.values())
+    if total > 1:
+        elapsed = time.time() - start
+        print(
+            '{} processed, {} skipped, {} failed in {:.2f}s ({:.1f} files/s)'
+            .format(
+                counts['processed'],
+                counts['skipped'],
+                counts['failed'],
+                elapsed,
+                total / elapsed if elapsed else 0.0,
+            ),
+            file=sys.stderr,
+        )
+    if args.stats:
+        print(polytaxis.disable_stats().format(), file=sys.stderr)
+    if counts['failed']:
+        sys.exit(1)
+
+def read_paths(source, null):
+    """Reads newline or NUL delimited paths from a binary file."""
+    delimiter = b'\0' if null else b'\n'
+    remainder = b''
+    while True:
+        buffer = source.read(64 * 1024)
+        if not buffer:
+            break
+        parts = (remainder + buffer).split(delimiter)
+        remainder = parts.pop()
+        for part in parts:
+            if part:
+                yield os.fsdecode(part)
+    if remainder:
+        yield os.fsdecode(remainder)
+
+def iterate_files(args):
+    """Yields the files to modify from the arguments and path list."""
+    def expand(filename):
+        if args.recursive and os.path.isdir(filename):
+            for root, dirs, files in os.walk(filename):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield filename
+
     for filename in args.file:
-        if args.strip:
-            polytaxis.strip_tags(filename)
-            continue
-
-        tags = polytaxis.get_tags(filename)
-        existing = tags is not None
-        if tags is None:
-            tags = {}
-
-        modify = False
-        if args.empty:
-            tags = {}
-            modify = True
-        for keyval in args.add:
-            key, val = polytaxis.decode_tag(keyval.encode('utf-8'))
-            if not key in tags:
-                tags[key] = set()
-            tags[key].add(val)
-            modify = True
-        for keyval in args.remove:
-            key, val = polytaxis.decode_tag(keyval.encode('utf-8'))
-            if not key in tags:
-                continue
-            try:
-                tags[key].remove(val)
-            except KeyError:
-                pass
-            modify = True
+        yield from expand(filename)
+    if args.from_file is not None:
+        if args.from_file == '-':
+            source = sys.stdin.buffer
+            for filename in read_paths(source, args.null):
+                yield from expand(filename)
+        else:
+            with open(args.from_file, 'rb') as source:
+                for filename in read_paths(source, args.null):
+                    yield from expand(filename)
+
+def map_ordered(function, items, jobs):
+    """Yields `function(item)` for each of `items` in order, running up to
+    `jobs` at once."""
+    if jobs == 1:
+        for item in items:
+            yield function(item)
+        return
+    items = iter(items)
+    done = object()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        while True:
+            while len(pending) < 4 * jobs:
+                item = next(items, done)
+                if item is done:
+                    break
+                pending.append(pool.submit(function, item))
+            if not pending:
+                break
+            yield pending.popleft().result()
+
+def run(filenames, args, unsized, jobs):
+    """Processes `filenames`, yielding results in order."""
+    return map_ordered(
+        lambda filename: process(filename, args, unsized),
+        filenames,
+        jobs,
+    )
+
+def process(filename, args, unsized):
+    """Applies the requested operations to one file.
+
+    Returns the filename, a status (`processed`, `skipped` or `failed`) and
+    text to print or None.
+    """
+    try:
+        return modify_file(filename, args, unsized)
+    except (OSError, ValueError, RuntimeError) as e:
+        return filename, 'failed', 'Error processing [{}]: {}'.format(
+            filename,
+            e,
+        )
+
+def parse_tags(keyvals):
+    tags = {}
+    for keyval in keyvals:
+        key, val = polytaxis.decode_tag(keyval.encode('utf-8'))
+        tags.setdefault(key, set()).add(val)
+    return tags
+
+def modify_file(filename, args, unsized):
+    if args.strip:
+        polytaxis.strip_tags(filename)
+        return filename, 'processed', None
+
+    view = polytaxis.get_tags(filename, lazy=True)
+    existing = view is not None
+    modify = bool(args.empty or args.add or args.remove)
+    add = parse_tags(args.add)
+    remove = parse_tags(args.remove)
+    if modify and existing and not args.empty:
+        # Patch the existing header rather than re-encoding it
+        polytaxis.update_tags(filename, add=add, remove=remove, unsized=unsized)
+        tags = polytaxis.get_tags(filename) if args.list else None
+    else:
+        tags = view.to_dict() if existing and not args.empty else {}
+        for key, vals in add.items():
+            tags.setdefault(key, set()).update(vals)
+        for key, vals in remove.items():
+            if key in tags:
+                tags[key].difference_update(vals)
         if modify:
             polytaxis.set_tags(filename, tags, unsized=unsized)
-        if args.list:
-            if not existing and not modify:
-                raise RuntimeError(
-                    'Cannot list existing tags; [{}] has no polytaxis header.'
-                )
-            print('Tags in {}:\n{}'.format(
-                filename,
-                polytaxis.encode_tags(tags).decode('utf-8'),
-            ))
+    if args.list:
+        if not existing and not modify:
+            return filename, 'skipped', (
+                'Cannot list existing tags; [{}] has no polytaxis header.'
+                .format(filename)
+            )
+        return filename, 'processed', 'Tags in {}:\n{}'.format(
+            filename,
+            polytaxis.encode_tags(tags).decode('utf-8'),
+        )
+    return filename, 'processed', None
 
 if __name__ == '__main__':
     main()
@@ -14,7 +14,9 @@ setup(
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: BSD License',
     ],
-    py_modules = ['polytaxis', 'ptmod'],
+    python_requires = '>=3.7',
+    packages = ['polytaxis'],
+    py_modules = ['ptmod'],
     entry_points = {
         'console_scripts': [
             'ptmod = ptmod:main',
@@ -1,9 +1,23 @@
 import unittest
 import io
 import os
+import sys
+import asyncio
 import collections
+import errno
+import tempfile
+import unittest.mock
+import shutil
+import json
+import contextlib
+import argparse
 
 import polytaxis
+import polytaxis.aio
+import polytaxis.index
+import polytaxis.store
+import polytaxis.watch
+import ptmod
 
 normal_tags = {'a': set(['a'])}
 
@@ -54,6 +68,19 @@ def open2r(filename):
     with open(filename, 'rb') as file:
         return file.read()
 
+def run_ptmod(main, argv):
+    """Runs a ptmod entry point, returning its exit code and output."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(stdout):
+        with contextlib.redirect_stderr(stderr):
+            try:
+                main(argv)
+            except SystemExit as e:
+                code = e.code
+    return code, stdout.getvalue(), stderr.getvalue()
+
 def res(filename):
     return os.path.join(os.path.dirname(__file__), filename)
 
@@ -82,6 +109,42 @@ class TestPolytaxis(unittest.TestCase):
         end['b'] = sorted(list(end['b']))
         self.assertEqual(begin, end)
 
+    def test_encode_tags_many(self):
+        batch = [
+            normal_tags,
+            {},
+            {'a': set(['a=\\']), 'b\n': set([None])},
+            normal_tags,
+        ]
+        self.assertEqual(
+            polytaxis.encode_tags_many(batch),
+            [polytaxis.encode_tags(tags) for tags in batch],
+        )
+        self.assertEqual(
+            polytaxis.encode_tags_many(batch)[2],
+            b'a=a\\=\\\\\n'
+            b'b\\\n\n'
+        )
+
+    def test_decode_terminated(self):
+        self.assertEqual(
+            polytaxis.decode_tags(b'a=a\nb=\\\x00b\n\x00c=c\n'),
+            {'a': set(['a']), 'b': set(['\x00b'])},
+        )
+
+    def test_decode_unterminated(self):
+        self.assertEqual(polytaxis.decode_tags(b'a=a\nb=b'), {'a': set(['a'])})
+        self.assertEqual(
+            polytaxis.decode_tags(b'a=a\\\nb=\\b'),
+            {},
+        )
+
+    def test_decode_empty_value(self):
+        self.assertEqual(
+            polytaxis.decode_tags(b'a=\n=b\nc\\=\n'),
+            {'a': set([None]), 'c=': set([None])},
+        )
+
     def test_encode_decode_one(self):
         begin = ('a', 'b')
         temp = polytaxis.encode_tag(*begin)
@@ -193,6 +256,44 @@ class TestPolytaxis(unittest.TestCase):
             {'a': set(['a'])},
         )
     
+    def parse_chunks(self, data, chunk_size):
+        parser = polytaxis.IncrementalHeaderParser()
+        payload = b''
+        for start in range(0, len(data), chunk_size):
+            payload += parser.feed(data[start:start + chunk_size])
+        payload += parser.close()
+        return parser, payload
+
+    def test_incremental(self):
+        for raw, header_length in (
+                (raw_unsized_notags, 18),
+                (raw_unsized_normal, 22),
+                (raw_sized_minimized_notags, 23),
+                (raw_sized_normal, 535),
+                (raw_sized_minimized_normal, 27)):
+            for chunk_size in (1, 2, 5, 1000):
+                parser, payload = self.parse_chunks(raw, chunk_size)
+                self.assertTrue(parser.tagged)
+                self.assertEqual(parser.payload_offset, header_length)
+                self.assertEqual(payload, b'wug')
+                self.assertEqual(
+                    parser.tags,
+                    normal_tags if b'a=a' in raw else {},
+                )
+
+    def test_incremental_untagged(self):
+        for raw in (b'', b'poly', b'wug'):
+            parser, payload = self.parse_chunks(raw, 1)
+            self.assertFalse(parser.tagged)
+            self.assertEqual(parser.payload_offset, 0)
+            self.assertEqual(payload, raw)
+
+    def test_incremental_truncated(self):
+        parser = polytaxis.IncrementalHeaderParser()
+        parser.feed(raw_unsized_normal[:-7])
+        with self.assertRaises(ValueError):
+            parser.close()
+
     def test_seek_missing(self):
         with open(res('missing.txt'), 'rb') as file:
             polytaxis.seek_past_tags(file)
@@ -362,6 +463,191 @@ class TestPolytaxisFiles(unittest.TestCase):
             b'wug',
         )
 
+    def test_get_probe_sized_large(self):
+        tags = {'a': set(['x' * 100]), 'b': set([None])}
+        polytaxis.set_tags(res('seed.txt'), tags=tags)
+        for probe_size in (1, 30, 64, 4096):
+            self.assertEqual(
+                polytaxis.get_tags(res('seed.txt.p'), probe_size=probe_size),
+                tags,
+            )
+
+    def test_get_probe_unsized_large(self):
+        tags = {'a': set(['x' * 100]), 'b': set([None])}
+        polytaxis.set_tags(res('seed.txt'), tags=tags, unsized=True)
+        for probe_size in range(1, 140):
+            self.assertEqual(
+                polytaxis.get_tags(res('seed.txt.p'), probe_size=probe_size),
+                tags,
+            )
+
+    def test_get_unsized_limit(self):
+        tags = {'a': set(['x' * 10000])}
+        polytaxis.set_tags(res('seed.txt'), tags=tags, unsized=True)
+        old_limit = polytaxis.unsized_limit
+        try:
+            polytaxis.unsized_limit = 10003
+            self.assertEqual(polytaxis.get_tags(res('seed.txt.p')), tags)
+            for limit in (10002, 100):
+                polytaxis.unsized_limit = limit
+                for probe_size in (1, 4096, 20000):
+                    with self.assertRaises(ValueError):
+                        polytaxis.get_tags(
+                            res('seed.txt.p'),
+                            probe_size=probe_size,
+                        )
+        finally:
+            polytaxis.unsized_limit = old_limit
+
+    def test_find_unsized_mark_eof(self):
+        with io.BytesIO(b'a=a\n<<<<' + b'x' * 100000) as file:
+            self.assertEqual(polytaxis._find_unsized_mark(file), None)
+        with io.BytesIO(b'a=a\n' * 5000 + b'<<<<\nwug') as file:
+            self.assertEqual(
+                polytaxis._find_unsized_mark(file),
+                b'a=a\n' * 5000,
+            )
+            self.assertEqual(file.read(), b'wug')
+
+    def test_get_probe_untagged(self):
+        self.assertEqual(
+            polytaxis.get_tags(res('seed.txt'), probe_size=1),
+            None,
+        )
+
+    def test_get_probe_truncated(self):
+        open2w(res('seed.txt'), b'polytaxis00 0000000512\na=a\n')
+        with self.assertRaises(ValueError):
+            polytaxis.get_tags(res('seed.txt'))
+
+    def test_get_lazy(self):
+        tags = {'a': set(['a', None]), 'b\n': set(['=\\'])}
+        polytaxis.set_tags(res('seed.txt'), tags=tags)
+        view = polytaxis.get_tags(res('seed.txt.p'), lazy=True)
+        self.assertIn('a', view)
+        self.assertNotIn('c', view)
+        self.assertEqual(view['a'], frozenset(['a', None]))
+        self.assertEqual(view['b\n'], frozenset(['=\\']))
+        self.assertEqual(sorted(view), ['a', 'b\n'])
+        self.assertEqual(view.to_dict(), tags)
+        with self.assertRaises(KeyError):
+            view['c']
+        with self.assertRaises(KeyError):
+            view[1]
+        self.assertNotIn(1, view)
+        self.assertNotIn(b'a', view)
+        self.assertNotIn('\ud800', view)
+        self.assertIsNone(view.get(1))
+        self.assertIsNone(view.get(b'a'))
+        with self.assertRaises(TypeError):
+            view['c'] = frozenset()
+        self.assertEqual(polytaxis.get_tags(res('missing.txt'), lazy=True), None)
+
+    def test_iter_tags(self):
+        tags = {'a': set(['a' * 1000, None]), 'b\n': set(['=\\'])}
+        for unsized in (False, True):
+            polytaxis.set_tags(res('seed.txt'), tags=tags, unsized=unsized)
+            for chunk_size in (1, 2, 7, 4096):
+                found = {}
+                for key, value in polytaxis.iter_tags(
+                        res('seed.txt.p'), chunk_size=chunk_size):
+                    found.setdefault(key, set()).add(value)
+                self.assertEqual(found, tags)
+            polytaxis.strip_tags(res('seed.txt.p'))
+        self.assertEqual(list(polytaxis.iter_tags(res('seed.txt'))), [])
+
+    def test_iter_tags_truncated(self):
+        with io.BytesIO(b'polytaxis00u\na=a\nb=b\n') as file:
+            with self.assertRaises(ValueError):
+                list(polytaxis.iter_tags(file, chunk_size=3))
+
+    def test_get_tags_many(self):
+        polytaxis.set_tags(res('seed.txt'), tags=normal_tags)
+        open2w(res('seed.txt'), b'polytaxis00 wug')
+        paths = [
+            res('seed.txt.p'),
+            res('missing.txt'),
+            res('seed.txt'),
+            res('nonexistent.txt'),
+        ] * 3
+        for ordered in (False, True):
+            results = list(polytaxis.get_tags_many(
+                paths,
+                workers=3,
+                ordered=ordered,
+                max_in_flight=2,
+            ))
+            if ordered:
+                self.assertEqual([path for path, _, _ in results], paths)
+            self.assertEqual(len(results), len(paths))
+            for path, tags, error in results:
+                if path == res('seed.txt.p'):
+                    self.assertEqual((tags, error), (normal_tags, None))
+                elif path == res('missing.txt'):
+                    self.assertEqual((tags, error), (None, None))
+                elif path == res('seed.txt'):
+                    self.assertIsInstance(error, ValueError)
+                else:
+                    self.assertIsInstance(error, OSError)
+
+    def test_get_tags_many_raise(self):
+        with self.assertRaises(OSError):
+            list(polytaxis.get_tags_many(
+                [res('nonexistent.txt')],
+                capture_errors=False,
+            ))
+
+    def test_update_tags(self):
+        polytaxis.set_tags(
+            res('seed.txt'),
+            tags={'a': set(['a', 'b']), 'c\n': set([None])},
+        )
+        before = open2r(res('seed.txt.p'))
+        self.assertEqual(
+            polytaxis.update_tags(
+                res('seed.txt.p'),
+                add={'a': set(['a'])},
+                remove={'d': set([None])},
+            ),
+            res('seed.txt.p'),
+        )
+        self.assertEqual(open2r(res('seed.txt.p')), before)
+        polytaxis.update_tags(
+            res('seed.txt.p'),
+            add={'d=': set(['x', 'y'])},
+            remove={'a': set(['b']), 'c\n': set([None]), 'd=': set(['y'])},
+        )
+        after = open2r(res('seed.txt.p'))
+        self.assertEqual(len(after), len(before))
+        self.assertEqual(
+            polytaxis.get_tags(res('seed.txt.p')),
+            {'a': set(['a']), 'd=': set(['x'])},
+        )
+
+    def test_update_tags_grow(self):
+        polytaxis.set_tags(res('seed.txt'), tags=normal_tags, minimize=True)
+        polytaxis.update_tags(res('seed.txt.p'), add={'b': set([None])})
+        self.assertEqual(
+            polytaxis.get_tags(res('seed.txt.p')),
+            {'a': set(['a']), 'b': set([None])},
+        )
+        polytaxis.update_tags(res('seed.txt.p'), unsized=True)
+        self.assertTrue(open2r(res('seed.txt.p')).startswith(b'polytaxis00u'))
+        polytaxis.strip_tags(res('seed.txt.p'))
+        self.assertEqual(open2r(res('seed.txt')), b'wug')
+
+    def test_update_tags_new(self):
+        self.assertEqual(
+            polytaxis.update_tags(res('seed.txt'), remove=normal_tags),
+            res('seed.txt'),
+        )
+        self.assertEqual(open2r(res('seed.txt')), b'wug')
+        self.assertEqual(
+            polytaxis.update_tags(res('seed.txt'), add=normal_tags),
+            res('seed.txt.p'),
+        )
+        self.assertEqual(polytaxis.get_tags(res('seed.txt.p')), normal_tags)
+
     def test_overwrite_safety_new(self):
         open2w(res('seed.txt.p'), b'wug')
         with self.assertRaises(RuntimeError):
@@ -373,6 +659,814 @@ class TestPolytaxisFiles(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             polytaxis.strip_tags(res('seed.txt.p'))
 
+class TestPolytaxisScan(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        os.makedirs(os.path.join(self.root, 'skip'))
+        for name in (
+                'one.txt',
+                os.path.join('a', 'two.txt'),
+                os.path.join('a', 'b', 'three.dat'),
+                os.path.join('skip', 'four.txt')):
+            path = os.path.join(self.root, name)
+            open2w(path, b'wug')
+            polytaxis.set_tags(path, tags={'name': set([name])})
+        open2w(os.path.join(self.root, 'a', 'plain.txt'), b'wug wug wug wug')
+        open2w(os.path.join(self.root, 'a', 'tiny.txt'), b'poly')
+        os.symlink(
+            os.path.join(self.root, 'a'),
+            os.path.join(self.root, 'link'),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def scan(self, **kwargs):
+        return sorted(
+            os.path.relpath(path, self.root)
+            for path, tags in polytaxis.scan(self.root, **kwargs)
+        )
+
+    def test_scan(self):
+        self.assertEqual(self.scan(), [
+            os.path.join('a', 'b', 'three.dat.p'),
+            os.path.join('a', 'two.txt.p'),
+            'one.txt.p',
+            os.path.join('skip', 'four.txt.p'),
+        ])
+
+    def test_scan_tags(self):
+        for path, tags in polytaxis.scan(self.root, readahead=0):
+            self.assertEqual(
+                tags,
+                {'name': set([os.path.relpath(path, self.root)[:-2]])},
+            )
+
+    def test_scan_filter(self):
+        self.assertEqual(
+            self.scan(include=['*.txt.p'], exclude=['skip']),
+            [os.path.join('a', 'two.txt.p'), 'one.txt.p'],
+        )
+
+    def test_scan_follow_symlinks(self):
+        self.assertEqual(len(self.scan(follow_symlinks=True)), 4)
+        os.symlink(
+            os.path.join(self.root, 'one.txt.p'),
+            os.path.join(self.root, 'one-link.p'),
+        )
+        self.assertIn('one-link.p', self.scan(follow_symlinks=True))
+
+    def test_scan_errors(self):
+        open2w(os.path.join(self.root, 'broken.p'), b'polytaxis00 wug')
+        with self.assertRaises(ValueError):
+            self.scan()
+        errors = []
+        self.assertEqual(len(self.scan(onerror=errors.append)), 4)
+        self.assertEqual(len(errors), 1)
+
+class TestPolytaxisIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tree = os.path.join(self.root, 'tree')
+        os.makedirs(os.path.join(self.tree, 'a'))
+        self.one = os.path.join(self.tree, 'one')
+        self.two = os.path.join(self.tree, 'a', 'two')
+        open2w(self.one, b'wug')
+        open2w(self.two, b'wug')
+        polytaxis.set_tags(self.one, tags={'x': set(['1']), 'y': set([None])})
+        polytaxis.set_tags(self.two, tags={'x': set(['2'])})
+        self.one += '.p'
+        self.two += '.p'
+        open2w(os.path.join(self.tree, 'plain'), b'wug wug wug wug')
+        self.index = polytaxis.index.TagIndex(os.path.join(self.root, 'db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root)
+
+    def test_refresh(self):
+        self.assertEqual(
+            self.index.refresh(self.tree),
+            {'read': 3, 'unchanged': 0, 'removed': 0},
+        )
+        self.assertEqual(self.index.find('x'), sorted([self.one, self.two]))
+        self.assertEqual(self.index.find('x', '2'), [self.two])
+        self.assertEqual(self.index.find('y', None), [self.one])
+        self.assertEqual(self.index.find('z'), [])
+        self.assertEqual(
+            self.index.get(self.one),
+            {'x': set(['1']), 'y': set([None])},
+        )
+        self.assertEqual(self.index.get(os.path.join(self.tree, 'plain')), None)
+
+    def test_refresh_incremental(self):
+        self.index.refresh(self.tree)
+        polytaxis.set_tags(self.two, tags={'x': set(['3', '4'])}, minimize=True)
+        os.unlink(self.one)
+        self.assertEqual(
+            self.index.refresh(self.tree),
+            {'read': 1, 'unchanged': 1, 'removed': 1},
+        )
+        self.assertEqual(self.index.find('x', '2'), [])
+        self.assertEqual(self.index.find('x', '4'), [self.two])
+        self.assertEqual(self.index.find('y'), [])
+
+class TestPolytaxisCopy(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed')
+        self.payload = os.urandom(3 * 1024 ** 2 + 17)
+        open2w(self.path, self.payload)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def roundtrip(self):
+        os.chmod(self.path, 0o640)
+        path = polytaxis.set_tags(self.path, tags=normal_tags, minimize=True)
+        self.assertEqual(
+            open2r(path),
+            raw_sized_minimized_normal[:-3] + self.payload,
+        )
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        polytaxis.set_tags(path, tags={'a': set(['b' * 1000])})
+        self.assertEqual(polytaxis.get_tags(path), {'a': set(['b' * 1000])})
+        polytaxis.strip_tags(path)
+        self.assertEqual(open2r(self.path), self.payload)
+        self.assertEqual(os.listdir(self.root), ['seed'])
+
+    def test_copy(self):
+        self.roundtrip()
+
+    def test_copy_fallback(self):
+        error = OSError(errno.ENOSYS, 'unsupported')
+        with unittest.mock.patch.object(
+                os, 'copy_file_range', side_effect=error, create=True):
+            self.roundtrip()
+            with unittest.mock.patch.object(
+                    os, 'sendfile', side_effect=error, create=True):
+                self.roundtrip()
+
+class TestPolytaxisAlign(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed')
+        self.payload = os.urandom(3 * 4096 + 17)
+        open2w(self.path, self.payload)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_write_align(self):
+        with io.BytesIO() as file:
+            polytaxis.write_tags(file, tags=normal_tags, align=4096)
+            self.assertEqual(len(file.getvalue()), 4096)
+            file.seek(0)
+            self.assertTrue(polytaxis.seek_past_tags(file))
+            self.assertEqual(file.tell(), 4096)
+
+    def roundtrip(self):
+        inode = os.stat(self.path).st_ino
+        block = os.stat(self.path).st_blksize
+        path = polytaxis.set_tags(self.path, tags=normal_tags, align=True)
+        data = open2r(path)
+        self.assertEqual(len(data), block + len(self.payload))
+        self.assertEqual(data[block:], self.payload)
+        self.assertEqual(polytaxis.get_tags(path), normal_tags)
+        tags = {'a': set(['b' * block])}
+        polytaxis.set_tags(path, tags=tags, minimize=True, align=True)
+        data = open2r(path)
+        self.assertEqual(len(data), 2 * block + len(self.payload))
+        self.assertEqual(data[2 * block:], self.payload)
+        self.assertEqual(polytaxis.get_tags(path), tags)
+        polytaxis.strip_tags(path)
+        self.assertEqual(open2r(self.path), self.payload)
+        self.assertEqual(os.listdir(self.root), ['seed'])
+        return inode == os.stat(self.path).st_ino
+
+    def test_align(self):
+        # Whether this is done in place depends on the filesystem of the
+        # temporary directory
+        self.roundtrip()
+
+    def test_align_fallback(self):
+        with unittest.mock.patch.object(
+                polytaxis, '_fallocate', return_value=False):
+            self.assertFalse(self.roundtrip())
+
+    def test_align_from_unsized(self):
+        block = os.stat(self.path).st_blksize
+        path = polytaxis.set_tags(self.path, tags=normal_tags, unsized=True)
+        polytaxis.set_tags(path, tags=normal_tags, unsized=False, align=True)
+        data = open2r(path)
+        self.assertEqual(len(data), block + len(self.payload))
+        self.assertEqual(data[block:], self.payload)
+        polytaxis.set_tags(path, tags=normal_tags, unsized=True)
+        polytaxis.update_tags(
+            path, add={'b': set([None])}, unsized=False, align=True)
+        data = open2r(path)
+        self.assertEqual(len(data), block + len(self.payload))
+        self.assertEqual(data[block:], self.payload)
+        self.assertEqual(
+            polytaxis.get_tags(path), {'a': set(['a']), 'b': set([None])})
+
+class TestPolytaxisGrowth(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed')
+        open2w(self.path, b'wug')
+        self.outcomes = []
+        polytaxis.header_stats.reset()
+        polytaxis.header_stats.callback = (
+            lambda filename, outcome: self.outcomes.append(outcome)
+        )
+
+    def tearDown(self):
+        polytaxis.header_stats.callback = None
+        polytaxis.directory_growth_policies.clear()
+        shutil.rmtree(self.root)
+
+    def header_size(self, path):
+        with open(path, 'rb') as file:
+            self.assertTrue(polytaxis.seek_past_tags(file))
+            return file.tell()
+
+    def test_policies(self):
+        self.assertEqual(polytaxis.grow_pow2(3), 512)
+        self.assertEqual(polytaxis.grow_pow2(513), 1024)
+        self.assertEqual(polytaxis.grow_fixed(100)(3), 103)
+        self.assertEqual(polytaxis.grow_percent(50)(10), 15)
+        self.assertEqual(polytaxis.grow_percent(50, minimum=8)(10), 18)
+        self.assertEqual(polytaxis.grow_blocks(64)(3), 64 - 23)
+        self.assertEqual(polytaxis.grow_blocks(64, slack=60)(3), 128 - 23)
+
+    def test_write_policy(self):
+        with io.BytesIO() as file:
+            polytaxis.write_tags(
+                file, tags=normal_tags, policy=polytaxis.grow_fixed(10))
+            self.assertEqual(len(file.getvalue()), 23 + 4 + 10)
+        with io.BytesIO() as file:
+            with self.assertRaises(ValueError):
+                polytaxis.write_tags(
+                    file, tags=normal_tags, policy=lambda length: 0)
+
+    def test_set_tags_policy(self):
+        path = polytaxis.set_tags(
+            self.path, normal_tags, policy=polytaxis.grow_fixed(8))
+        self.assertEqual(self.header_size(path), 23 + 4 + 8)
+        polytaxis.update_tags(
+            path, add={'b': set(['c'])}, policy=polytaxis.grow_fixed(8))
+        polytaxis.update_tags(
+            path, add={'d': set(['e' * 8])}, policy=polytaxis.grow_fixed(8))
+        polytaxis.update_tags(path, add={'b': set(['c'])})
+        self.assertEqual(self.header_size(path), 23 + 19 + 8)
+        self.assertEqual(open2r(path)[-3:], b'wug')
+        self.assertEqual(
+            self.outcomes,
+            ['rewrite', 'in_place', 'rewrite', 'unchanged'],
+        )
+        self.assertEqual(polytaxis.header_stats.rewrite, 2)
+        self.assertEqual(polytaxis.header_stats.avoided, 1)
+        self.assertEqual(polytaxis.header_stats.as_dict(), {
+            'unchanged': 1,
+            'in_place': 1,
+            'insert_range': 0,
+            'rewrite': 2,
+        })
+
+    def test_directory_policy(self):
+        polytaxis.directory_growth_policies[self.root] = (
+            polytaxis.grow_fixed(1)
+        )
+        os.mkdir(os.path.join(self.root, 'sub'))
+        path = os.path.join(self.root, 'sub', 'seed')
+        open2w(path, b'wug')
+        self.assertIs(
+            polytaxis.growth_policy(path),
+            polytaxis.directory_growth_policies[self.root],
+        )
+        self.assertIs(
+            polytaxis.growth_policy('/elsewhere'),
+            polytaxis.default_growth_policy,
+        )
+        path = polytaxis.set_tags(path, normal_tags)
+        self.assertEqual(self.header_size(path), 23 + 4 + 1)
+
+class TestPolytaxisCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for index in range(3):
+            path = os.path.join(self.root, str(index))
+            open2w(path, b'wug')
+            self.paths.append(
+                polytaxis.set_tags(path, tags={'i': set([str(index)])})
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_hit_miss(self):
+        cache = polytaxis.TagCache()
+        tags = cache.get_tags(self.paths[0])
+        self.assertEqual(tags, {'i': frozenset(['0'])})
+        self.assertIs(cache.get_tags(self.paths[0]), tags)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with self.assertRaises(TypeError):
+            tags['j'] = frozenset()
+
+    def test_evict(self):
+        cache = polytaxis.TagCache(max_entries=2)
+        for path in self.paths:
+            cache.get_tags(path)
+        self.assertEqual((len(cache), cache.evictions), (2, 1))
+        cache.get_tags(self.paths[0])
+        self.assertEqual(cache.misses, 4)
+        cache = polytaxis.TagCache(max_bytes=6)
+        for path in self.paths:
+            cache.get_tags(path)
+        self.assertEqual((len(cache), cache.evictions), (2, 1))
+
+    def test_invalidate(self):
+        cache = polytaxis.TagCache()
+        cache.get_tags(self.paths[0])
+        polytaxis.set_tags(self.paths[0], tags={'i': set(['x'])})
+        self.assertEqual(
+            cache.get_tags(self.paths[0]),
+            {'i': frozenset(['x'])},
+        )
+        polytaxis.strip_tags(self.paths[0])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_tags(self.paths[0][:-2]), None)
+
+class TestPolytaxisUnwrap(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed.p')
+        self.payload = bytes(range(256)) * 64
+        with open(self.path, 'wb') as file:
+            polytaxis.write_tags(file, tags=normal_tags)
+            file.write(self.payload)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read(self):
+        with polytaxis.open_unwrap(self.path) as file:
+            self.assertIsInstance(file, io.BufferedReader)
+            self.assertEqual(file.read(), self.payload)
+        with polytaxis.open_unwrap(self.path, buffering=0) as file:
+            self.assertIsInstance(file, io.RawIOBase)
+            self.assertTrue(file.readable())
+            self.assertFalse(file.writable())
+            self.assertTrue(file.seekable())
+            buffer = bytearray(10)
+            self.assertEqual(file.readinto(memoryview(buffer)), 10)
+            self.assertEqual(buffer, self.payload[:10])
+            self.assertEqual(
+                file.seek(-5, os.SEEK_END), len(self.payload) - 5)
+            self.assertEqual(file.read(), self.payload[-5:])
+            self.assertEqual(
+                file.seek(-100, os.SEEK_CUR), len(self.payload) - 100)
+            self.assertEqual(file.seek(-10 ** 6, os.SEEK_CUR), 0)
+            self.assertEqual(file.read(3), self.payload[:3])
+            with self.assertRaises(io.UnsupportedOperation):
+                file.fileno()
+            with self.assertRaises(io.UnsupportedOperation):
+                file.write(b'x')
+        self.assertTrue(file.closed)
+
+    def test_untagged(self):
+        path = os.path.join(self.root, 'plain')
+        open2w(path, b'wug')
+        with polytaxis.open_unwrap(path) as file:
+            self.assertEqual(file.read(), b'wug')
+
+    def test_write(self):
+        with polytaxis.open_unwrap(self.path, 'wb') as file:
+            self.assertIsInstance(file, io.BufferedWriter)
+            file.write(b'abc')
+            file.truncate()
+        with polytaxis.open_unwrap(self.path, 'ab') as file:
+            file.write(b'def')
+        with polytaxis.open_unwrap(self.path, 'r+b') as file:
+            self.assertEqual(file.read(), b'abcdef')
+            file.seek(1)
+            file.write(b'B')
+        self.assertEqual(polytaxis.get_tags(self.path), normal_tags)
+        with polytaxis.open_unwrap(self.path) as file:
+            self.assertEqual(file.read(), b'aBcdef')
+
+    def test_mmap(self):
+        with polytaxis.open_unwrap(self.path, mmap=True) as view:
+            self.assertIsInstance(view, memoryview)
+            self.assertTrue(view.readonly)
+            self.assertEqual(view, self.payload)
+        with polytaxis.open_unwrap(self.path, 'r+b', mmap=True) as view:
+            view[:3] = b'abc'
+        with polytaxis.open_unwrap(self.path) as file:
+            self.assertEqual(file.read(3), b'abc')
+        self.assertEqual(
+            polytaxis.get_tags(self.path, mmap=True), normal_tags)
+        self.assertEqual(
+            polytaxis.get_tags(self.path, mmap=True, lazy=True).to_dict(),
+            normal_tags,
+        )
+        with self.assertRaises(ValueError):
+            polytaxis.open_unwrap(self.path, 'wb', mmap=True)
+
+    def test_mmap_unsized(self):
+        path = os.path.join(self.root, 'unsized.p')
+        open2w(path, raw_unsized_normal)
+        with polytaxis.open_unwrap(path, mmap=True) as view:
+            self.assertEqual(view, b'wug')
+        self.assertEqual(polytaxis.get_tags(path, mmap=True), normal_tags)
+        open2w(path, raw_unsized_normal[:-9])
+        with self.assertRaises(ValueError):
+            polytaxis.get_tags(path, mmap=True)
+
+    def test_mmap_untagged(self):
+        path = os.path.join(self.root, 'plain')
+        open2w(path, b'wug')
+        with polytaxis.open_unwrap(path, mmap=True) as view:
+            self.assertEqual(view, b'wug')
+        self.assertIsNone(polytaxis.get_tags(path, mmap=True))
+        open2w(path, b'')
+        with polytaxis.open_unwrap(path, mmap=True) as view:
+            self.assertEqual(view, b'')
+        self.assertIsNone(polytaxis.get_tags(path, mmap=True))
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            polytaxis.open_unwrap(self.path, 'r')
+
+class TestPolytaxisWatch(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        self.old = os.path.join(self.root, 'sub', 'old')
+        open2w(self.old, b'wug wug wug wug')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def collect(self, watcher):
+        events = []
+        while True:
+            batch = watcher.poll(timeout=0.5)
+            if not batch:
+                return events
+            events.extend(batch)
+
+    def change(self):
+        path = os.path.join(self.root, 'new')
+        open2w(path, b'wug')
+        path = polytaxis.set_tags(path, normal_tags)
+        polytaxis.update_tags(path, add={'b': set([None])})
+        shutil.rmtree(os.path.join(self.root, 'sub'))
+        return path
+
+    def test_poll(self):
+        with polytaxis.watch.Watcher(
+                self.root, backend='poll', interval=0.05) as watcher:
+            path = self.change()
+            self.assertEqual(
+                sorted(self.collect(watcher)),
+                [
+                    ('changed', path, {'a': set(['a']), 'b': set([None])}),
+                    ('removed', self.old, None),
+                ],
+            )
+
+    @unittest.skipUnless(
+        polytaxis.watch._inotify(), 'inotify is not supported')
+    def test_inotify(self):
+        with polytaxis.watch.Watcher(
+                self.root, backend='inotify', debounce=0.05) as watcher:
+            path = self.change()
+            os.makedirs(os.path.join(self.root, 'made', 'deep'))
+            deep = os.path.join(self.root, 'made', 'deep', 'file')
+            open2w(deep, b'wug')
+            self.assertEqual(
+                sorted(self.collect(watcher)),
+                [
+                    ('changed', deep, None),
+                    ('changed', path, {'a': set(['a']), 'b': set([None])}),
+                    (
+                        'removed_tree',
+                        os.path.join(self.root, 'sub'),
+                        None,
+                    ),
+                ],
+            )
+
+    def test_index(self):
+        index = polytaxis.index.TagIndex(':memory:')
+        events = polytaxis.watch.watch(
+            self.root, index=index, backend='poll', interval=0.05)
+        path = os.path.join(self.root, 'new')
+        open2w(path, b'wug')
+        path = polytaxis.set_tags(path, normal_tags)
+        self.assertEqual(next(events), ('changed', path, normal_tags))
+        self.assertEqual(index.get(path), normal_tags)
+        os.unlink(path)
+        self.assertEqual(next(events), ('removed', path, None))
+        self.assertIsNone(index.get(path))
+        self.assertEqual(index.find('a'), [])
+        events.close()
+        index.close()
+
+    def test_closed(self):
+        watcher = polytaxis.watch.Watcher(self.root, backend='poll')
+        watcher.close()
+        with self.assertRaises(ValueError):
+            watcher.poll(timeout=0)
+
+    def test_truncated(self):
+        path = polytaxis.set_tags(self.old, normal_tags)
+        with polytaxis.watch.Watcher(
+                self.root, backend='poll', interval=0.05) as watcher:
+            open2w(path, b'')
+            self.assertEqual(self.collect(watcher), [('changed', path, None)])
+
+    def test_ptmod(self):
+        events = [
+            polytaxis.watch.Event(
+                'changed', self.old, {'a': set(['b', None, 'a'])}),
+            polytaxis.watch.Event('removed', self.old, None),
+        ]
+        output = io.StringIO()
+        with unittest.mock.patch.object(
+                polytaxis.watch,
+                'watch',
+                lambda *args, **kwargs: (event for event in events)):
+            with contextlib.redirect_stdout(output):
+                ptmod.watch_main([self.root, '--poll'])
+        self.assertEqual(
+            [json.loads(line) for line in output.getvalue().splitlines()],
+            [
+                {
+                    'event': 'changed',
+                    'path': self.old,
+                    'tags': {'a': [None, 'a', 'b']},
+                },
+                {'event': 'removed', 'path': self.old, 'tags': None},
+            ],
+        )
+
+class TestPolytaxisStats(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed')
+        open2w(self.path, b'wug')
+        self.calls = []
+        self.stats = polytaxis.enable_stats(
+            lambda *args: self.calls.append(args))
+
+    def tearDown(self):
+        polytaxis.disable_stats()
+        shutil.rmtree(self.root)
+
+    def test_stats(self):
+        path = polytaxis.set_tags(self.path, normal_tags)
+        self.assertEqual(polytaxis.get_tags(path), normal_tags)
+        polytaxis.update_tags(path, add={'b': set([None])})
+        polytaxis.set_tags(path, normal_tags, unsized=True)
+        self.assertEqual(polytaxis.get_tags(path), normal_tags)
+        polytaxis.strip_tags(path)
+        self.assertIs(polytaxis.disable_stats(), self.stats)
+        polytaxis.get_tags(self.path)
+        operations = self.stats.operations
+        self.assertEqual(operations['get_tags']['calls'], 2)
+        self.assertEqual(operations['set_tags']['calls'], 2)
+        self.assertEqual(operations['update_tags']['calls'], 1)
+        self.assertEqual(operations['strip_tags']['calls'], 1)
+        self.assertEqual(operations['write_tags']['calls'], 2)
+        self.assertEqual(operations['update_tags']['bytes_written'], 7)
+        self.assertEqual(operations['write_tags']['bytes_written'], 29 + 22)
+        self.assertEqual(self.stats.outcomes['in_place'], 1)
+        self.assertEqual(self.stats.outcomes['rewrite'], 2)
+        self.assertEqual(self.stats.unsized_scans, 2)
+        self.assertEqual(self.stats.bytes_copied, 3 * 3)
+        self.assertGreater(self.stats.reads, 0)
+        self.assertGreater(self.stats.seeks, 0)
+        self.assertEqual(
+            [call[0] for call in self.calls if call[0] != 'decode_tags'],
+            [
+                'write_tags',
+                'set_tags',
+                'get_tags',
+                'update_tags',
+                'write_tags',
+                'set_tags',
+                'get_tags',
+                'strip_tags',
+            ],
+        )
+        self.assertIn('update_tags: 1 calls', self.stats.format())
+        self.stats.reset()
+        self.assertEqual(self.stats.operations, {})
+        self.assertEqual(self.stats.reads, 0)
+
+class TestPolytaxisStore(unittest.TestCase):
+    def setUp(self):
+        self.store = polytaxis.store.TagStore()
+        self.tags = {'a': set(['b', None]), 'c': set(['d'])}
+        self.store.add('x', self.tags)
+        self.store.add('y', {'a': set(['b', None]), 'c': set(['d'])})
+        self.store.add('z', {})
+
+    def test_get(self):
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(sorted(self.store), ['x', 'y', 'z'])
+        self.assertEqual(self.store.get('x'), self.tags)
+        self.assertEqual(self.store['z'], {})
+        self.assertIsNone(self.store.get('w'))
+        with self.assertRaises(KeyError):
+            self.store['w']
+        self.assertIs(self.store._files['x'], self.store._files['y'])
+        self.store.add('x', None)
+        self.assertNotIn('x', self.store)
+        del self.store['y']
+        self.assertEqual(list(self.store), ['z'])
+
+    def test_release(self):
+        self.store.add('w', {'e': set(['f'])})
+        self.assertEqual(len(self.store._shared), 3)
+        del self.store['w']
+        self.store.add('x', None)
+        self.assertEqual(len(self.store._shared), 2)
+        del self.store['y']
+        self.assertEqual(len(self.store._shared), 1)
+        self.store.add('y', self.tags)
+        self.store.add('x', self.tags)
+        self.assertEqual(self.store.keys(), ['a', 'c', 'e'])
+        self.store.compact()
+        self.assertEqual(self.store.keys(), ['a', 'c'])
+        self.assertEqual(self.store._values, [None, 'b', 'd'])
+        self.assertEqual(self.store.get('x'), self.tags)
+        self.assertEqual(self.store.get('z'), {})
+        self.assertIs(self.store._files['x'], self.store._files['y'])
+        self.assertTrue(self.store.has_tag('y', 'c', 'd'))
+
+    def test_membership(self):
+        self.assertTrue(self.store.has_tag('x', 'a'))
+        self.assertTrue(self.store.has_tag('x', 'a', None))
+        self.assertTrue(self.store.has_tag('x', 'c', 'd'))
+        self.assertFalse(self.store.has_tag('x', 'c', None))
+        self.assertFalse(self.store.has_tag('x', 'c', 'b'))
+        self.assertFalse(self.store.has_tag('x', 'e'))
+        self.assertFalse(self.store.has_tag('z', 'a'))
+        self.assertFalse(self.store.has_tag('w', 'a'))
+        self.assertEqual(self.store.keys('x'), ['a', 'c'])
+        self.assertEqual(self.store.keys('z'), [])
+        self.assertEqual(self.store.keys(), ['a', 'c'])
+        self.assertEqual(sorted(self.store.find('c', 'd')), ['x', 'y'])
+        self.assertEqual(list(self.store.find('c', 'e')), [])
+        self.assertEqual(list(self.store.find('e')), [])
+
+    def test_load(self):
+        root = tempfile.mkdtemp()
+        try:
+            open2w(os.path.join(root, 'a.p'), raw_sized_normal)
+            open2w(os.path.join(root, 'b'), b'wug')
+            store = polytaxis.store.TagStore()
+            self.assertEqual(store.load(polytaxis.scan(root)), 1)
+            self.assertEqual(
+                store.get(os.path.join(root, 'a.p')), normal_tags)
+            store = polytaxis.store.TagStore()
+            self.assertEqual(
+                store.load(polytaxis.get_tags_many([
+                    os.path.join(root, 'a.p'),
+                    os.path.join(root, 'b'),
+                    os.path.join(root, 'c'),
+                ])),
+                1,
+            )
+            self.assertEqual(list(store), [os.path.join(root, 'a.p')])
+        finally:
+            shutil.rmtree(root)
+
+class TestPolytaxisAio(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'seed')
+        open2w(self.path, b'wug')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_roundtrip(self):
+        async def run():
+            self.assertEqual(await polytaxis.aio.get_tags(self.path), None)
+            path = await polytaxis.aio.set_tags(
+                self.path,
+                tags=normal_tags,
+                minimize=True,
+            )
+            self.assertEqual(path, self.path + '.p')
+            self.assertEqual(open2r(path), raw_sized_minimized_normal)
+            self.assertEqual(await polytaxis.aio.get_tags(path), normal_tags)
+            found = []
+            async for found_path, tags in polytaxis.aio.scan(
+                    self.root, batch_size=1):
+                found.append((found_path, tags))
+            self.assertEqual(found, [(path, normal_tags)])
+            await polytaxis.aio.strip_tags(path)
+            self.assertEqual(open2r(self.path), b'wug')
+        asyncio.run(run())
+
+    def test_concurrent(self):
+        paths = []
+        for index in range(20):
+            path = os.path.join(self.root, str(index))
+            open2w(path, b'wug')
+            paths.append(path)
+
+        async def run():
+            polytaxis.aio.configure(max_workers=3)
+            try:
+                return await asyncio.gather(*(
+                    polytaxis.aio.set_tags(path, tags={'i': set([path])})
+                    for path in paths
+                ))
+            finally:
+                polytaxis.aio.shutdown()
+        new_paths = asyncio.run(run())
+        for path, new_path in zip(paths, new_paths):
+            self.assertEqual(polytaxis.get_tags(new_path), {'i': set([path])})
+
+class TestPolytaxisQuery(unittest.TestCase):
+    raw_tags = polytaxis.encode_tags(collections.OrderedDict((
+        ('author', set(['rendaw'])),
+        ('draft', set([None])),
+        ('year', set(['2015'])),
+        ('s p=ce', set(['a\\b'])),
+    )))
+
+    def check(self, query, expected):
+        self.assertEqual(polytaxis.match(self.raw_tags, query), expected)
+        self.assertEqual(
+            polytaxis.compile_query(query).match_tags(
+                polytaxis.decode_tags(self.raw_tags)
+            ),
+            expected,
+        )
+
+    def test_terms(self):
+        self.check('author', True)
+        self.check('author=rendaw', True)
+        self.check('author=other', False)
+        self.check('draft=', True)
+        self.check('year=', False)
+        self.check('s\\ p\\=ce=a\\\\b', True)
+
+    def test_operators(self):
+        self.check('author=rendaw AND NOT draft OR year=2015', True)
+        self.check('author=rendaw AND NOT draft', False)
+        self.check('NOT author OR NOT year', False)
+        self.check('author AND (year=2016 OR draft)', True)
+        self.check('NOT NOT missing', False)
+        self.check('missing OR NOT other', True)
+
+    def test_short_circuit(self):
+        # The second tag is invalid UTF-8 and would fail decoding, but it
+        # isn't reached once the result is known.
+        self.assertTrue(polytaxis.match(b'a=a\n\xff=\xff\n', 'a'))
+        with self.assertRaises(ValueError):
+            polytaxis.decode_tags(b'a=a\n\xff=\xff\n')
+
+    def test_invalid(self):
+        for query in ('', 'a AND', '(a', 'a b', 'AND', 'a)'):
+            with self.assertRaises(ValueError):
+                polytaxis.compile_query(query)
+
+    def test_files(self):
+        root = tempfile.mkdtemp()
+        try:
+            paths = []
+            for index in range(3):
+                path = os.path.join(root, str(index))
+                open2w(path, b'wug')
+                paths.append(polytaxis.set_tags(
+                    path,
+                    tags={'i': set([str(index)]), 'even': set([None])}
+                    if index % 2 == 0 else {'i': set([str(index)])},
+                ))
+            open2w(os.path.join(root, 'plain'), b'wug wug wug wug')
+            self.assertTrue(polytaxis.match(paths[0], 'even'))
+            self.assertFalse(polytaxis.match(paths[1], 'even'))
+            self.assertFalse(
+                polytaxis.match(os.path.join(root, 'plain'), 'NOT even')
+            )
+            self.assertEqual(
+                sorted(polytaxis.query.find(root, 'NOT even OR i=2')),
+                paths[1:],
+            )
+        finally:
+            shutil.rmtree(root)
+
 class TestPolytaxisFilesInternal(unittest.TestCase):
     def setUp(self):
         open2w(res('seed.txt'), b'wug')
@@ -404,6 +1498,236 @@ class TestPolytaxisFilesInternal(unittest.TestCase):
             raw_sized_minimized_normal,
         )
 
+class TestPtmodMigrate(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'd'))
+        self.payload = b'wug' * 100
+        self.sized = []
+        for name in ('a', os.path.join('d', 'b'), 'e'):
+            path = os.path.join(self.root, name)
+            open2w(path, self.payload)
+            self.sized.append(polytaxis.set_tags(path, normal_tags))
+        path = os.path.join(self.root, 'u')
+        open2w(path, self.payload)
+        self.unsized = polytaxis.set_tags(path, normal_tags, unsized=True)
+        self.untagged = os.path.join(self.root, 'd', 'plain')
+        open2w(self.untagged, self.payload)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, path, kind):
+        self.assertEqual(ptmod.header_kind(path), kind)
+        self.assertEqual(polytaxis.get_tags(path), normal_tags)
+        with polytaxis.open_unwrap(path) as file:
+            self.assertEqual(file.read(), self.payload)
+
+    def test_dry_run(self):
+        code, out, err = run_ptmod(
+            ptmod.migrate_main, ['-n', '--to', 'unsized', self.root])
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(out.splitlines()), sorted(self.sized))
+        self.assertIn(
+            '3 files ({} bytes) to convert to unsized; 1 converted already, '
+            '1 untagged'.format(
+                sum(os.path.getsize(path) for path in self.sized)),
+            err,
+        )
+        for path in self.sized:
+            self.assertEqual(ptmod.header_kind(path), 'sized')
+
+    def test_convert(self):
+        code, out, err = run_ptmod(
+            ptmod.migrate_main, ['--to', 'unsized', '-j', '2', self.root])
+        self.assertEqual(code, 0)
+        self.assertIn('3 rewritten', err)
+        for path in self.sized + [self.unsized]:
+            self.check(path, 'unsized')
+        code, out, err = run_ptmod(
+            ptmod.migrate_main, ['--to', 'sized', self.root])
+        self.assertEqual(code, 0)
+        self.assertIn('4 rewritten', err)
+        for path in self.sized + [self.unsized]:
+            self.check(path, 'sized')
+        self.assertEqual(open2r(self.untagged), self.payload)
+
+    def test_align(self):
+        code, out, err = run_ptmod(
+            ptmod.migrate_main, ['--to', 'sized', '--align', self.root])
+        self.assertEqual(code, 0)
+        self.check(self.unsized, 'sized')
+        with open(self.unsized, 'rb') as file:
+            self.assertTrue(polytaxis.seek_past_tags(file))
+            self.assertEqual(file.tell(), os.stat(self.unsized).st_blksize)
+
+    def test_journal(self):
+        journal = os.path.join(self.root, 'journal')
+        done, failed, partial = self.sized
+        with open(journal, 'w') as file:
+            file.write(json.dumps({'path': done, 'outcome': 'rewrite'}) + '\n')
+            file.write(json.dumps(
+                {'path': failed, 'outcome': 'failed', 'error': 'x'}) + '\n')
+            file.write(json.dumps({'path': partial})[:10])
+        self.assertEqual(ptmod.read_journal(journal), set([done]))
+        code, out, err = run_ptmod(
+            ptmod.migrate_main,
+            ['--to', 'unsized', '--journal', journal, self.root])
+        self.assertEqual(code, 0)
+        self.assertIn('1 journaled', err)
+        self.assertEqual(ptmod.header_kind(done), 'sized')
+        self.check(failed, 'unsized')
+        self.check(partial, 'unsized')
+        self.assertEqual(
+            ptmod.read_journal(journal), set([done, failed, partial]))
+        self.assertEqual(
+            ptmod.read_journal(os.path.join(self.root, 'missing')), set())
+
+    def test_rate(self):
+        self.assertEqual(ptmod.parse_rate('20M'), 20 * 1024 ** 2)
+        self.assertEqual(ptmod.parse_rate('512'), 512)
+        for text in ('0', 'fastK'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                ptmod.parse_rate(text)
+        limiter = ptmod.RateLimiter(1000)
+        with unittest.mock.patch.object(ptmod.time, 'sleep') as sleep:
+            limiter.acquire(500)
+            limiter.acquire(500)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, delta=0.1)
+
+class TestPtmodMain(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for name in ('f0', os.path.join('d1', 'f1'), os.path.join('d2', 'f2')):
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open2w(path, b'wug')
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_main(self, argv, stdin=b''):
+        with unittest.mock.patch.object(sys, 'argv', ['ptmod'] + argv):
+            with unittest.mock.patch.object(
+                    sys, 'stdin', io.TextIOWrapper(io.BytesIO(stdin))):
+                return run_ptmod(lambda argv: ptmod.main(), None)
+
+    def test_read_paths(self):
+        block = 64 * 1024
+        paths = [
+            'a' * (block - 1),
+            'b' * block,
+            'c' * 10,
+            'd' * (2 * block + 5),
+            'e',
+        ]
+        for null in (False, True):
+            delimiter = b'\0' if null else b'\n'
+            data = delimiter.join(path.encode() for path in paths)
+            self.assertEqual(
+                list(ptmod.read_paths(io.BytesIO(data), null)), paths)
+            self.assertEqual(
+                list(ptmod.read_paths(io.BytesIO(data + delimiter), null)),
+                paths,
+            )
+        self.assertEqual(
+            list(ptmod.read_paths(io.BytesIO(b'x\n\ny\0z\n'), False)),
+            ['x', 'y\0z'],
+        )
+        self.assertEqual(list(ptmod.read_paths(io.BytesIO(b''), True)), [])
+
+    def test_recursive(self):
+        code, out, err = self.run_main(
+            ['-R', '-j', '2', '-a', 'k=v', self.root])
+        self.assertEqual(code, 0)
+        self.assertIn('3 processed, 0 skipped, 0 failed', err)
+        # Walk order: a directory's files, then its subdirectories by name
+        tagged = [path + '.p' for path in self.paths]
+        for path in tagged:
+            self.assertEqual(polytaxis.get_tags(path), {'k': set(['v'])})
+        code, out, err = self.run_main(['-R', '-j', '2', self.root])
+        self.assertEqual(code, 0)
+        self.assertEqual(
+            [
+                line[len('Tags in '):-1] for line in out.splitlines()
+                if line.startswith('Tags in ')
+            ],
+            tagged,
+        )
+
+    def test_failure(self):
+        corrupt = os.path.join(self.root, 'd1', 'corrupt')
+        open2w(corrupt, b'polytaxis00 0000000512\na=a\n')
+        code, out, err = self.run_main(
+            ['-R', '-j', '4', '-a', 'k', self.root])
+        self.assertEqual(code, 1)
+        self.assertIn('Error processing [{}]'.format(corrupt), err)
+        self.assertIn('3 processed, 0 skipped, 1 failed', err)
+        for path in self.paths:
+            self.assertEqual(
+                polytaxis.get_tags(path + '.p'), {'k': set([None])})
+
+    def test_stdin(self):
+        odd = os.path.join(self.root, 'new\nline')
+        open2w(odd, b'wug')
+        code, out, err = self.run_main(
+            ['-0', '-a', 'k'],
+            stdin=b'\0'.join(
+                os.fsencode(path) for path in [odd] + self.paths[:2]),
+        )
+        self.assertEqual(code, 0)
+        self.assertIn('3 processed', err)
+        for path in [odd] + self.paths[:2]:
+            self.assertEqual(
+                polytaxis.get_tags(path + '.p'), {'k': set([None])})
+        self.assertTrue(os.path.exists(self.paths[2]))
+
+class TestPtmodFind(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'd'))
+        self.a = os.path.join(self.root, 'a')
+        self.b = os.path.join(self.root, 'd', 'b')
+        open2w(self.a, b'wug')
+        open2w(self.b, b'wug')
+        self.a = polytaxis.set_tags(self.a, {'n': set(['1'])})
+        self.b = polytaxis.set_tags(
+            self.b, {'n': set(['2']), 'draft': set([None])})
+        open2w(os.path.join(self.root, 'c'), b'wug wug wug wug')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find(self):
+        code, out, err = run_ptmod(
+            ptmod.find_main, ['n AND NOT draft', self.root])
+        self.assertEqual((code, out, err), (0, self.a + '\n', ''))
+        code, out, err = run_ptmod(
+            ptmod.find_main, ['-0', 'n=1 OR draft', self.root])
+        self.assertEqual(code, 0)
+        self.assertTrue(out.endswith('\0'))
+        self.assertEqual(sorted(out[:-1].split('\0')), [self.a, self.b])
+
+    def test_invalid(self):
+        code, out, err = run_ptmod(ptmod.find_main, ['n AND', self.root])
+        self.assertEqual(code, 2)
+        self.assertEqual(out, '')
+        self.assertIn('ptmod find: error:', err)
+
+    def test_errors(self):
+        corrupt = os.path.join(self.root, 'd', 'corrupt')
+        open2w(corrupt, b'polytaxis00 0000000512\na=a\n')
+        missing = os.path.join(self.root, 'missing')
+        code, out, err = run_ptmod(
+            ptmod.find_main, ['n=1', self.root, missing])
+        self.assertEqual(code, 1)
+        self.assertEqual(out, self.a + '\n')
+        self.assertIn(corrupt, err)
+        self.assertIn(missing, err)
+
 class TestRealLife(unittest.TestCase):
     def test_broken1(self):
         with open(res('broken1.txt.p'), 'rb') as file: